@@ -1,34 +1,155 @@
 from __future__ import annotations
-from threading import Event
-from collections import deque
+from threading import Condition
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import objectsync_server
-from typing import Dict
+from typing import Any, Dict, List, Optional, Set, Tuple
+import ctypes
+import heapq
+import itertools
+import json
+import threading
+import time
+import traceback
 from objectsync_server import server
 from objectsync_server.command import *
 import edge
 import node
+from node.node import NodeCancelled
+from node.cache import ResultCache
 import objects
+from kernel import Kernel
 
-class MyDeque(deque):
-    # https://stackoverflow.com/questions/56821682/having-the-deque-with-the-advantages-of-queue-in-a-thread
-    def __init__(self):
-        super().__init__()
-        self.not_empty = Event()
-        #self.not_empty.set()
+class RunQueue:
+    '''
+    The nodes and tasks waiting to run on the space thread. Any thread can push(); the space thread pop()s.
 
-    def append(self, elem):
-        super().append(elem)
-        self.not_empty.set()
+    Items with a higher priority run first. Among items of the same priority, the order is the queue's policy:
+        'lifo' - the latest pushed runs first, so execution goes depth-first through the graph
+        'fifo' - the earliest pushed runs first (breadth-first)
+    push(fifo=True) overrides the policy for an item, which keeps posted tasks in order.
 
-    def appendleft(self, elem):
-        super().appendleft(elem)
-        self.not_empty.set()
+    An item is queued at most once. Pushing a queued item again only raises its priority if the new one is higher.
+    cancel() removes a queued item. Removed and reprioritized entries stay in the heap, marked invalid, until they are
+    popped or the heap is rebuilt.
 
-    def pop(self):
-        self.not_empty.wait()  # Wait until not empty, or next append call
-        if not (len(self) - 1):
-            self.not_empty.clear()
-        return super().pop()
+    The consumer marks the items it runs with start() and done(). A running item isn't queued, so it can be pushed again
+    and runs once more after it is done.
+    '''
+    # Fields of a heap entry
+    PRIORITY, ORDER, ITEM, PUSH_TIME, VALID = range(5)
+
+    def __init__(self, policy = 'lifo'):
+        assert policy in ('lifo', 'fifo')
+        self.policy = policy
+        self.heap : List[list] = [] # Entries: [-priority, order, item, push time, valid]
+        self.entries : Dict[Any, list] = {} # Queued item -> its valid entry
+        self.running : Set[Any] = set() # Items between start() and done()
+        self.counter = itertools.count(1)
+        self.not_empty = Condition()
+
+        # Counters
+        self.pushed = 0
+        self.deduplicated = 0
+        self.cancelled = 0
+        self.popped = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def push(self, item, priority = 0, fifo = None) -> bool:
+        '''
+        Queue an item. Returns False if it was already queued.
+        '''
+        if fifo is None:
+            fifo = self.policy == 'fifo'
+        with self.not_empty:
+            push_time = time.perf_counter()
+            entry = self.entries.get(item)
+            if entry is not None:
+                self.deduplicated += 1
+                if -priority >= entry[self.PRIORITY]:
+                    return False
+                # Requeue with the higher priority, but keep waiting time
+                entry[self.VALID] = False
+                push_time = entry[self.PUSH_TIME]
+            else:
+                self.pushed += 1
+
+            order = next(self.counter)
+            entry = [-priority, order if fifo else -order, item, push_time, True]
+            heapq.heappush(self.heap, entry)
+            self.entries[item] = entry
+            self.max_depth = max(self.max_depth, len(self.entries))
+            self.not_empty.notify()
+            return True
+
+    def cancel(self, item) -> bool:
+        '''
+        Remove a queued item. Returns False if it isn't queued.
+        '''
+        with self.not_empty:
+            entry = self.entries.pop(item, None)
+            if entry is None:
+                return False
+            entry[self.VALID] = False
+            self.cancelled += 1
+            if len(self.heap) > 64 and len(self.entries) * 2 < len(self.heap):
+                self.heap = [entry for entry in self.heap if entry[self.VALID]]
+                heapq.heapify(self.heap)
+            return True
+
+    def pop(self, with_priority = False):
+        '''
+        Remove and return the next item, or (item, priority) if with_priority is True. Waits until there is one.
+        '''
+        with self.not_empty:
+            while not self.entries:
+                self.not_empty.wait()
+            while True:
+                entry = heapq.heappop(self.heap)
+                if entry[self.VALID]:
+                    break
+            item = entry[self.ITEM]
+            del self.entries[item]
+            wait = time.perf_counter() - entry[self.PUSH_TIME]
+            self.popped += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if with_priority:
+                return item, -entry[self.PRIORITY]
+            return item
+
+    def start(self, item):
+        with self.not_empty:
+            self.running.add(item)
+
+    def done(self, item):
+        with self.not_empty:
+            self.running.discard(item)
+
+    def is_running(self, item) -> bool:
+        return item in self.running
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def stats(self):
+        with self.not_empty:
+            return {
+                'depth' : len(self.entries),
+                'max_depth' : self.max_depth,
+                'running' : len(self.running),
+                'pushed' : self.pushed,
+                'deduplicated' : self.deduplicated,
+                'cancelled' : self.cancelled,
+                'popped' : self.popped,
+                'mean_wait' : self.total_wait / self.popped if self.popped else 0.0,
+                'max_wait' : self.max_wait,
+            }
 
 class DequeLock:
     def __init__(self,env:Env):
@@ -40,16 +161,50 @@ class DequeLock:
 
 class Env(objectsync_server.Space):
 
+    # Where the work of parallel nodes (see Node.parallel) runs: 'thread' or 'process' for a pool of max_workers (None for the
+    # pool's default), or None to run every node on the space thread.
+    executor : Optional[str] = 'thread'
+    max_workers : Optional[int] = None
+
+    # Order of queued nodes of the same priority ('lifo' or 'fifo', see RunQueue).
+    # Posted tasks (like messages from clients) run before nodes, in the order they are posted.
+    run_policy = 'lifo'
+    task_priority = 100
+
+    # Seconds a node may run before it is cancelled, unless the node class sets its own Node.time_limit. None for no limit.
+    # The watchdog checks the running nodes every watchdog_interval seconds.
+    node_time_limit : Optional[float] = None
+    watchdog_interval = 0.1
+
+    # Run the code of CodeNode and EvalAssignNode in a kernel process of the space (see kernel.py) instead of on the space
+    # thread. The kernel has its own namespace, not the globals of this module.
+    use_kernel = False
+
+    # Bytes of FunctionNode results kept for reuse, for node classes that set FunctionNode.memoize
+    result_cache_bytes = 256 << 20
+
     def __init__(self,name, obj_classes, root_obj_class:type ):
         super(Env, self).__init__(name, obj_classes,root_obj_class)
         self.globals=globals()
         self.locals={}
-        self.node_deque = MyDeque()
+        self.run_queue = RunQueue(self.run_policy)
 
         # If a node produces a backward signal, prevent its sibling to be activated by setting lock_deque to True
         self.lock_deque = False
-        self.running_node : Optional[node.Node] = None
-        
+        self.running_node : Optional[node.Node] = None # The node running on the space thread
+        self.run_start = 0.0
+        self.run_lock = threading.Lock() # Guards running_node, so cancel() only interrupts the node it means to
+        self.thread_id : Optional[int] = None
+
+        self.pool : Optional[Executor] = None
+        # Parallel nodes whose work is on the pool -> (future, start time, (func, args) of the work)
+        self.in_flight : Dict[node.Node,Tuple[Future,float,tuple]] = {}
+        self.killed_for_others : Set[node.Node] = set() # In-flight nodes whose workers abandon() killed for another node
+        # Nodes waiting for an in-flight node they read from or write to, or for their own earlier run -> their priorities
+        self.deferred : Dict[node.Node,int] = {}
+        self.kernel : Optional[Kernel] = None
+        self.result_cache = ResultCache(self.result_cache_bytes)
+
     def get_deque_lock(self):
         return DequeLock(self)
 
@@ -57,16 +212,263 @@ class Env(objectsync_server.Space):
         for node_class in self.node_classes.values():
             self.send_message({'command':'new','info':node_class.get_class_info()})
 
-    def add_to_deque(self,node):
-        if not self.lock_deque:
-            self.node_deque.append(node)
+    def add_to_deque(self,n:node.Node,priority = 0) -> bool:
+        '''
+        Queue a node, or raise its priority if it is already queued or deferred. A running node is queued again, to run
+        after its current run. Returns False if the node isn't queued (while lock_deque is set).
+        '''
+        if self.lock_deque:
+            return False
+        if n in self.deferred:
+            self.deferred[n] = max(self.deferred[n],priority)
+            return True
+        self.run_queue.push(n,priority)
+        return True
+
+    def is_queued(self,n:node.Node) -> bool:
+        return n in self.run_queue or n in self.deferred
+
+    def post(self,task):
+        # Tasks from other threads (like messages from clients) share the queue with nodes, so they run between nodes
+        self.run_queue.push(task,self.task_priority,fifo = True)
+
+    def dequeue(self,n:node.Node) -> bool:
+        '''
+        Remove a node from the run queue or from the deferred nodes. Returns False if it is in neither.
+        '''
+        return self.run_queue.cancel(n) or self.deferred.pop(n,None) is not None
+
+    def cancel_node(self,n:node.Node):
+        '''
+        Remove a node from the run queue, if it is queued.
+        '''
+        if self.dequeue(n):
+            n.deactivate()
+
+    def execute(self,code:str):
+        '''
+        Run code in the space's namespace, printing the value of a trailing expression.
+        '''
+        if self.kernel is not None:
+            self.kernel.execute(code)
+        else:
+            node.node.exec_(code,self.globals,self.locals)
+
+    def evaluate(self,code:str):
+        if self.kernel is not None:
+            return self.kernel.evaluate(code)
+        return eval(code,self.globals,self.locals)
+
+    def assign(self,name:str,value):
+        if self.kernel is not None:
+            self.kernel.assign(name,value)
+        else:
+            self.globals.update({name: value})
+
+    def handle_command(self,m,ws):
+        if m['command'] == 'run stats':
+            self.send_message(f"msg run queue {json.dumps(self.run_queue.stats())}",ws)
+            self.send_message(f"msg result cache {json.dumps(self.result_cache.stats())}",ws)
+        else:
+            super().handle_command(m,ws)
+
+    def interrupt(self,message,ws):
+        '''
+        Handle "cancel" on the event loop thread, as the space thread may be busy running the node to cancel.
+        '''
+        if not isinstance(message,str) or '"cancel"' not in message:
+            return False
+        try:
+            m = json.loads(message)
+        except ValueError:
+            return False
+        if not isinstance(m,dict) or m.get('command') != 'cancel':
+            return False
+        if self.cancel(m.get('id'),'Cancelled by client'):
+            self.send_message("msg cancelled",ws)
+        else:
+            self.send_message("msg nothing to cancel",ws)
+        return True
+
+    def cancel(self,id = None,reason = 'Cancelled'):
+        '''
+        Stop a node, or the node running on the space thread if id is None. Can be called from any thread.
+        Returns False if there is no such node.
+
+        - A node running on the space thread gets NodeCancelled raised in it. This happens at its next Python instruction,
+          so a blocking call in C code finishes first. Node code can also call Node.check_cancelled() to stop earlier.
+        - The work of a parallel node is dropped if it hasn't started. Otherwise its result is ignored, and with a process pool the
+          workers are killed and the pool replaced.
+        - A queued node is removed from the run queue.
+        '''
+        with self.run_lock:
+            n = self.running_node if id is None else self.objs.get(id)
+            if not isinstance(n, node.Node):
+                return False
+            n.cancel_reason = reason
+            if n is self.running_node:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.thread_id), ctypes.py_object(NodeCancelled))
+
+        if n in self.in_flight:
+            self.abandon(n)
+        self.post(lambda: self.cancel_node(n))
+        return True
+
+    def abandon(self,n:node.Node):
+        entry = self.in_flight.get(n)
+        if entry is None or entry[0].cancel():
+            return
+        if isinstance(self.pool, ProcessPoolExecutor):
+            # A process can't be interrupted, so the workers are killed. The broken pool is replaced in finish_parallel(), and
+            # the work of the other in-flight nodes is submitted to the new pool again.
+            self.killed_for_others.update(other for other in list(self.in_flight) if other is not n)
+            for process in list(self.pool._processes.values()):
+                process.terminate()
+
+    def end_run(self):
+        with self.run_lock:
+            self.running_node = None
+            # Drop a NodeCancelled that is raised after the node has finished
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.thread_id), None)
+
+    def time_limit(self,n:node.Node):
+        return n.time_limit if n.time_limit is not None else self.node_time_limit
+
+    def watchdog_loop(self):
+        '''
+        Cancel the nodes that run longer than their time limit.
+        '''
+        while not self.flag_exit:
+            time.sleep(self.watchdog_interval)
+            now = time.perf_counter()
+            n = self.running_node
+            if n is not None and self.time_limit(n) is not None and now - self.run_start > self.time_limit(n):
+                with self.run_lock:
+                    expired = n is self.running_node
+                if expired:
+                    self.cancel(n.id,f'Time limit of {self.time_limit(n)} seconds exceeded')
+            for n, (future, start, work) in list(self.in_flight.items()):
+                if self.time_limit(n) is not None and now - start > self.time_limit(n) and n.cancel_reason is None:
+                    self.cancel(n.id,f'Time limit of {self.time_limit(n)} seconds exceeded')
 
     def main_loop(self):
+        if self.executor == 'thread':
+            self.pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix = f'{self.name} worker')
+        elif self.executor == 'process':
+            self.pool = ProcessPoolExecutor(self.max_workers)
+        if self.use_kernel:
+            self.kernel = Kernel(self.name)
+
         self.flag_exit = 0
+        self.thread_id = threading.get_ident()
+        threading.Thread(target = self.watchdog_loop, name = f'{self.name} watchdog', daemon = True).start()
         while not self.flag_exit:
-            self.running_node = self.node_deque.pop()
-            if self.running_node == 'EXIT_SIGNAL':
-                return
+            try:
+                item, priority = self.run_queue.pop(with_priority = True)
+                if item == 'EXIT_SIGNAL':
+                    break
+
+                if not isinstance(item, node.Node):
+                    item()
+                    continue
+
+                if self.run_queue.is_running(item) or self.conflicts(item):
+                    # Activated again while its work is on the pool, or waiting for another in-flight node
+                    self.deferred[item] = priority
+                    continue
+
+                self.lock_deque = False
+                self.run_queue.start(item)
+                if item.parallel and self.pool is not None:
+                    self.start_parallel(item)
+                    if item not in self.in_flight:
+                        self.run_queue.done(item)
+                    continue
+
+                with self.run_lock:
+                    self.running_node = item
+                    self.run_start = time.perf_counter()
+                try:
+                    item.run()
+                finally:
+                    self.end_run()
+                    self.run_queue.done(item)
+            except NodeCancelled:
+                # Raised after the node's own handler, or while it was finishing in running_finished(). Make sure it isn't left
+                # running or shown as queued.
+                self.end_run()
+                if isinstance(item, node.Node):
+                    self.run_queue.done(item)
+                    self.dequeue(item)
+                    item.deactivate()
+            except Exception:
+                # One failing task (like an autosave that can't write) must not stop the space
+                traceback.print_exc()
+
+        self.flag_exit = 1
+        if self.pool is not None:
+            self.pool.shutdown(wait = False)
+        if self.kernel is not None:
+            self.kernel.stop()
+
+    def conflicts(self,n:node.Node):
+        '''
+        Whether a node reads from or writes to an in-flight node. A reader of a flow without a value could pull (through a
+        backward signal) the in-flight node's outputs before they are ready, and a writer could replace a value the in-flight
+        node hasn't been activated for yet, so it waits until the in-flight node finishes.
+        '''
+        if not self.in_flight:
+            return False
+        for port in n.port_list:
+            for flow in port.flows:
+                if port.isInput:
+                    if flow.tail in self.in_flight and not flow.active:
+                        return True
+                elif flow.head in self.in_flight:
+                    return True
+        return False
+
+    def start_parallel(self,n:node.Node):
+        '''
+        Gather the node's inputs here, run its work on the pool, and finish it on the space thread when the work is done.
+        Nodes that don't read from each other run on the pool at the same time.
+        '''
+        works = []
+        def submit(func,*args):
+            works.append((func,args))
+            return self.pool.submit(func,*args)
+        future = n.start_parallel_run(submit)
+        if future is None:
+            return
+        self.track(n,future,works[0] if works else None)
+
+    def track(self,n:node.Node,future:Future,work:Optional[tuple]):
+        self.in_flight[n] = (future, time.perf_counter(), work)
+        future.add_done_callback(lambda future: self.post(lambda: self.finish_parallel(n,future)))
+
+    def finish_parallel(self,n:node.Node,future:Future):
+        entry = self.in_flight.get(n)
+        if entry is None or entry[0] is not future:
+            return
+        del self.in_flight[n]
+        if isinstance(self.pool, ProcessPoolExecutor) and self.pool._broken:
+            # The workers were killed (see abandon()) or crashed
+            self.pool = ProcessPoolExecutor(self.max_workers)
+        killed_for_others = n in self.killed_for_others
+        self.killed_for_others.discard(n)
+        if (killed_for_others and n.cancel_reason is None and entry[2] is not None and not future.cancelled()
+                and isinstance(future.exception(), BrokenProcessPool)):
+            # Killed with the workers of another node. Run the work again.
+            func, args = entry[2]
+            self.track(n,self.pool.submit(func,*args),entry[2])
+            return
+        self.lock_deque = False
+        try:
+            n.finish_parallel_run(future)
+        finally:
+            self.run_queue.done(n)
 
-            self.lock_deque = False
-            self.running_node.run()
\ No newline at end of file
+        # Retry the nodes that waited for an in-flight node, including n if it was activated again
+        deferred, self.deferred = self.deferred, {}
+        for waiting, priority in deferred.items():
+            self.run_queue.push(waiting,priority)
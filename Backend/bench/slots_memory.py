@@ -0,0 +1,67 @@
+'''
+Bytes allocated per instance of the classes that declare __slots__ (attributes, commands, history items, ports and
+components), measured with tracemalloc.
+
+Run from the Backend directory:
+    python bench/slots_memory.py [count]
+
+To compare with the classes before __slots__, run it on a checkout of the commit before they were added.
+'''
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from objectsync_server import Space, Object
+from objectsync_server.object import Attribute
+from objectsync_server.command import CommandAttribute, CommandHead, HistoryItem
+from node.node import Port, Component
+
+class BenchObject(Object):
+    frontend_type = 'BenchObject'
+
+class BenchSpace(Space):
+    write_ahead_log = False
+
+    def main_loop(self):
+        pass
+
+class BenchNode:
+    '''
+    Just what Port and Component need from a node.
+    '''
+    def __init__(self):
+        self.port_list = []
+        self.components = []
+
+def bytes_per_instance(make, count : int) -> float:
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    instances = [make(i) for i in range(count)]
+    end = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del instances
+    return (end - start) / count
+
+def main(count : int = 20000):
+    space = BenchSpace('bench', {'BenchObject' : BenchObject})
+    obj = BenchObject(space, {'id' : 'bench'}, True, '0')
+    node = BenchNode()
+    head = HistoryItem(CommandHead())
+
+    # The figures include the list that keeps the instances, and containers the instances add themselves to, like
+    # Object.attributes and Node.port_list
+    cases = {
+        'Attribute' : lambda i: Attribute(obj, 'a%d' % i, 'String', ''),
+        'CommandAttribute' : lambda i: CommandAttribute(space, 'bench', 'a', i),
+        'HistoryItem' : lambda i: HistoryItem(head.command),
+        'Port' : lambda i: Port(node, 'DataPort', True, 1, name = 'x'),
+        'Component' : lambda i: Component(node, 'x', 'Text', 'y'),
+    }
+    print(f'Bytes per instance ({count} instances, Python {sys.version_info.major}.{sys.version_info.minor})')
+    for name, make in cases.items():
+        print(f'  {name:<18}{bytes_per_instance(make, count):6.0f}')
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
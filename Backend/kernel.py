@@ -0,0 +1,209 @@
+from __future__ import annotations
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Optional
+import contextlib
+import io
+import multiprocessing
+import pickle
+import sys
+import traceback
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# A kernel is a process that runs the code of a space's nodes (see Env.use_kernel), like a jupyter kernel. The server
+# process keeps the objects and the clients, so a crash or a memory blowup in node code only takes down the kernel.
+#
+# Requests and replies are pickled tuples sent over a pipe:
+#   ('execute', code)         -> ('ok', None, output)     run code in the kernel's namespace
+#   ('evaluate', code)        -> ('ok', value, output)    evaluate an expression in the namespace
+#   ('assign', name, value)   -> ('ok', None, '')         set a variable in the namespace
+#   ('stop',)
+# A request that raises replies ('error', formatted traceback, output).
+#
+# An ndarray or a CPU torch tensor of at least shared_memory_threshold bytes in a request or a reply isn't pickled: it is
+# copied into a shared memory block, and the receiver copies it out and unlinks the block.
+
+shared_memory_threshold = 1 << 20
+
+class KernelError(Exception):
+    '''
+    Raised in the server when node code raises in the kernel. The message is the kernel's traceback.
+    '''
+
+class KernelDied(KernelError):
+    pass
+
+class Kernel:
+    '''
+    The server's side of a kernel. Not thread safe; the space thread makes all the requests.
+
+    A request waits in a Python loop, so Env.cancel() can interrupt it. The kernel is then killed, as the code it runs
+    can't be interrupted, and a new one is started with an empty namespace. The same happens if the kernel dies. The next
+    request waits until the new kernel is ready.
+    '''
+    poll_interval = 0.05
+
+    def __init__(self, name : str):
+        self.name = name
+        self.process : Optional[multiprocessing.process.BaseProcess] = None
+        self.connection : Optional[Connection] = None
+        self.restarts = 0
+        self.ready = False
+        self.start()
+
+    def start(self):
+        # Spawn rather than fork, as the server has threads
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target = kernel_main, args = (child_connection,), name = f'{self.name} kernel', daemon = True)
+        self.process.start()
+        child_connection.close()
+        self.ready = False # The kernel sends b'ready' once it has imported its modules
+
+    def restart(self):
+        self.kill()
+        self.restarts += 1
+        print(f'Kernel of {self.name} restarted')
+        self.start()
+
+    def kill(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        if self.connection is not None:
+            self.connection.close()
+        self.process = None
+        self.connection = None
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            try:
+                send(self.connection, ('stop',))
+                self.process.join(1)
+            except OSError:
+                pass
+        self.kill()
+
+    def request(self, *request):
+        '''
+        Send a request and wait for the reply. Prints the output of the code, so it goes to the requesting node's output.
+        '''
+        if self.process is None or not self.process.is_alive():
+            self.restart()
+        try:
+            if not self.ready:
+                self.wait()
+                self.connection.recv_bytes()
+                self.ready = True
+            send(self.connection, request)
+            self.wait()
+            status, value, output = receive(self.connection)
+        except (EOFError, OSError):
+            self.restart()
+            raise KernelDied(f'The kernel of {self.name} died')
+        except BaseException:
+            # Cancelled while the kernel was running
+            self.restart()
+            raise
+        print(output, end = '')
+        if status == 'error':
+            raise KernelError(value)
+        return value
+
+    def wait(self):
+        while not self.connection.poll(self.poll_interval):
+            if not self.process.is_alive():
+                return
+
+    def execute(self, code : str):
+        self.request('execute', code)
+
+    def evaluate(self, code : str) -> Any:
+        return self.request('evaluate', code)
+
+    def assign(self, name : str, value):
+        self.request('assign', name, value)
+
+def kernel_main(connection : Connection):
+    from node.node import exec_
+    namespace = {'__name__' : '__kernel__'}
+    connection.send_bytes(b'ready')
+    while True:
+        try:
+            request = receive(connection)
+        except EOFError:
+            return
+        kind = request[0]
+        if kind == 'stop':
+            return
+
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                value = None
+                if kind == 'execute':
+                    exec_(request[1], namespace)
+                elif kind == 'evaluate':
+                    value = eval(request[1], namespace)
+                elif kind == 'assign':
+                    namespace[request[1]] = request[2]
+                else:
+                    raise ValueError(f'Unknown kernel request {kind}')
+            reply = ('ok', value, output.getvalue())
+            data = dumps(reply)
+        except Exception:
+            reply = ('error', traceback.format_exc(), output.getvalue())
+            data = dumps(reply)
+        connection.send_bytes(data)
+
+class SharedMemoryPickler(pickle.Pickler):
+    '''
+    Pickles large ndarrays and CPU tensors as references to shared memory blocks.
+    '''
+    def reducer_override(self, obj):
+        if np is not None and type(obj) is np.ndarray and shareable(obj):
+            return attach_array, share_array(obj)
+        torch = sys.modules.get('torch') # Only if the code has imported it
+        if torch is not None and isinstance(obj, torch.Tensor) and obj.device.type == 'cpu' and not obj.requires_grad:
+            array = obj.numpy()
+            if shareable(array):
+                return attach_tensor, share_array(array)
+        return NotImplemented
+
+def shareable(array) -> bool:
+    return array.nbytes >= shared_memory_threshold and array.dtype.fields is None and not array.dtype.hasobject
+
+def share_array(array) -> tuple:
+    block = SharedMemory(create = True, size = array.nbytes)
+    np.ndarray(array.shape, array.dtype, buffer = block.buf)[...] = array
+    name = block.name
+    block.close()
+    return (name, array.shape, array.dtype.str)
+
+def attach_array(name : str, shape : tuple, dtype : str):
+    block = SharedMemory(name = name)
+    try:
+        array = np.ndarray(shape, dtype, buffer = block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+    return array
+
+def attach_tensor(name : str, shape : tuple, dtype : str):
+    import torch
+    return torch.from_numpy(attach_array(name, shape, dtype))
+
+def dumps(obj) -> bytes:
+    f = io.BytesIO()
+    SharedMemoryPickler(f, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return f.getvalue()
+
+def send(connection : Connection, obj):
+    connection.send_bytes(dumps(obj))
+
+def receive(connection : Connection):
+    return pickle.loads(connection.recv_bytes())
@@ -0,0 +1,127 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Tuple
+import hashlib
+import pickle
+import sys
+import numpy as np
+
+# Values of these types can't change, so they are keyed by themselves. Subclasses of the builtin ones can have mutable
+# attributes, so the types must match exactly.
+IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes, range, type(Ellipsis))
+NUMPY_SCALAR_TYPES = (np.number, np.bool_, np.datetime64, np.timedelta64, np.str_, np.bytes_)
+
+def fingerprint(value) -> Hashable:
+    '''
+    A hashable key of a value's content, for keying cached results on the inputs of a function.
+    ndarrays and tensors are keyed by their shape, dtype and a hash of their data, immutable values by themselves and
+    containers by their items. Any other object is keyed by a hash of its pickle, so changing it in place changes the key.
+    Raises TypeError if the value can't be keyed (like an object that can't be pickled).
+    '''
+    if type(value) is np.ndarray:
+        return ('ndarray', value.shape, str(value.dtype.descr), digest(value))
+    torch = sys.modules.get('torch') # Only if some code has imported it
+    if torch is not None and isinstance(value, torch.Tensor):
+        array = value.detach().cpu().numpy()
+        return ('tensor', str(value.dtype), str(value.device), array.shape, digest(array))
+    if type(value) in (list, tuple):
+        return (type(value).__name__, tuple(fingerprint(item) for item in value))
+    if type(value) is dict:
+        return ('dict', tuple(sorted((fingerprint(k), fingerprint(v)) for k, v in value.items())))
+    if type(value) is frozenset:
+        return ('frozenset', frozenset(fingerprint(item) for item in value))
+    if type(value) in IMMUTABLE_TYPES or isinstance(value, NUMPY_SCALAR_TYPES):
+        # The type tells 1, 1.0 and True apart
+        return (type(value).__qualname__, value)
+    try:
+        return ('pickle', type(value).__qualname__, hashlib.blake2b(pickle.dumps(value, pickle.HIGHEST_PROTOCOL), digest_size = 16).digest())
+    except Exception:
+        raise TypeError(f"Can't fingerprint a {type(value).__qualname__}")
+
+def digest(array : np.ndarray) -> bytes:
+    if array.dtype.hasobject:
+        raise TypeError("Can't fingerprint an object array")
+    try:
+        data = memoryview(np.ascontiguousarray(array)).cast('B')
+    except ValueError:
+        # Like datetime64 arrays, which don't export a buffer format that can be cast
+        raise TypeError(f"Can't fingerprint a {array.dtype} array")
+    return hashlib.blake2b(data, digest_size = 16).digest()
+
+def estimate_size(value) -> int:
+    '''
+    Estimated bytes of a result, including the data of ndarrays and tensors in it.
+    '''
+    if isinstance(value, np.ndarray):
+        return sys.getsizeof(value) + (0 if value.flags.owndata else value.nbytes)
+    torch = sys.modules.get('torch')
+    if torch is not None and isinstance(value, torch.Tensor):
+        return sys.getsizeof(value) + value.element_size() * value.nelement()
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    return size
+
+class ResultCache:
+    '''
+    Results of FunctionNode functions keyed on (function, fingerprints of the inputs), for FunctionNode.memoize.
+    The least recently used results are evicted when the estimated bytes exceed max_bytes. A result larger than
+    max_bytes isn't kept.
+
+    Cached results are shared by every run that hits them, like a result is shared by a node's output flows, so node
+    code must not modify its inputs in place.
+    '''
+    def __init__(self, max_bytes : int):
+        self.max_bytes = max_bytes
+        self.entries : OrderedDict[Hashable,Tuple[Any,int]] = OrderedDict() # key -> (result, size)
+        self.bytes = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0 # Runs whose inputs couldn't be fingerprinted
+
+    def get(self, key : Hashable) -> Tuple[bool, Any]:
+        '''
+        Returns (True, result) on a hit and (False, None) on a miss.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return True, entry[0]
+
+    def put(self, key : Hashable, result):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        size = estimate_size(result)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (result, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last = False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> Dict[str,Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries' : len(self.entries),
+            'bytes' : self.bytes,
+            'max_bytes' : self.max_bytes,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'hit_rate' : self.hits / lookups if lookups else 0.0,
+            'evictions' : self.evictions,
+            'uncacheable' : self.uncacheable,
+        }
@@ -6,11 +6,15 @@ import sys
 sys.path.append('D:/NNNode/Backend') # for debugging
 from objectsync_server.command import History
 import sys
+import io
+import threading
 import traceback
 import config
+from concurrent.futures import Future
+from .cache import fingerprint
 
 from typing import TYPE_CHECKING
-from typing import Dict, List, final
+from typing import Dict, List, Optional, final
 if TYPE_CHECKING:
     import edge
     from Environment import Env
@@ -22,18 +26,60 @@ class node_StringIO():
         self.node = node
     def write(self,value):
         self.node.added_output += value
+    def flush(self):
+        pass
 
-# redirect stdout
-class stdoutIO():
-    def __init__(self,node):
-        self.node = node
+class ThreadStdout():
+    '''
+    Installed as sys.stdout by redirect_stdout. A write goes to the stream the current thread redirected to, if any, so
+    nodes running at the same time on the space thread and on the worker pool each get their own prints.
+    '''
+    install_lock = threading.Lock()
+
+    def __init__(self,stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+    def target(self):
+        return getattr(self.local,'target',None) or self.stdout
+    def write(self,value):
+        return self.target().write(value)
+    def flush(self):
+        self.target().flush()
+    def __getattr__(self,name):
+        return getattr(self.stdout,name)
+
+# redirect stdout of the current thread
+class redirect_stdout():
+    def __init__(self,stream):
+        self.stream = stream
     def __enter__(self):
-        self.old = sys.stdout
-        stdout = node_StringIO(self.node)
-        sys.stdout = stdout
-        return stdout
+        with ThreadStdout.install_lock:
+            if not isinstance(sys.stdout,ThreadStdout):
+                sys.stdout = ThreadStdout(sys.stdout)
+            self.stdout = sys.stdout
+        self.old = getattr(self.stdout.local,'target',None)
+        self.stdout.local.target = self.stream
+        return self.stream
     def __exit__(self, type, value, traceback):
-        sys.stdout = self.old
+        self.stdout.local.target = self.old
+
+class stdoutIO(redirect_stdout):
+    def __init__(self,node):
+        super().__init__(node_StringIO(node))
+
+def capture_output(func,*args):
+    '''
+    Run the work of a parallel node on a worker. Returns (result, printed output). If func raises, the output so far is
+    kept in the exception's node_output.
+    '''
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output):
+            result = func(*args)
+    except BaseException as e:
+        e.node_output = output.getvalue()
+        raise
+    return result, output.getvalue()
 
 import ast
 # exec that prints correctly
@@ -54,6 +100,12 @@ def exec_(script,globals=None, locals=None):
         exec(script, globals, locals)
     return output
 
+class NodeCancelled(BaseException):
+    '''
+    Raised in a running node to stop it (see Env.cancel()).
+    It is a BaseException, so `except Exception` in node code doesn't catch it.
+    '''
+
 def v3(x,y,z):
     '''
     Unity Vector3 Json format
@@ -65,6 +117,8 @@ class Port():
     Different node classes might have Port classes that own different properties for frontend to read. 
     In such case, inherit this
     '''
+    __slots__ = ('id', 'type', 'isInput', 'max_connections', 'name', 'description', 'pos', 'flows', 'with_order', 'on_edge_activate')
+
     def __init__(self,node: Node, type : str, isInput : bool, max_connections : int = '64', name : str = '',
      description : str = '',pos = [0,0,0], on_edge_activate = lambda : None, with_order : bool = False,is_ready = lambda :False,require_value =None):
         self.id = str(len(node.port_list))
@@ -107,6 +161,8 @@ class Component:
     A component controls an objsync.Attribute.
     Component class have no set() method. When component value is modified, client should send "atr" command, which leads to objsync.Attribute.set()
     '''
+    __slots__ = ('name', 'type', 'target_attr')
+
     def __init__(self,node : Node,name,type,target_attr):
         node.components.append(self)
         self.name = name # for UI to display
@@ -124,11 +180,14 @@ class Node(objsync.Object):
     frontend_type = 'GeneralNode'
     category = 'uncategorized'
 
-    def serialize(self) -> Dict:
-        d = super(Node, self).serialize()
+    def serialize_fields(self) -> Dict:
+        d = super(Node, self).serialize_fields()
+        if self.port_infos is None:
+            # Ports don't change after initialize(), so their infos are computed once
+            self.port_infos = [port.get_dict() for port in self.port_list]
         d.update({
             "category" : self.category,"doc":self.__doc__,"name":self.name,
-            'portInfos' : [port.get_dict() for port in self.port_list],
+            'portInfos' : self.port_infos,
         })
         return d
 
@@ -137,47 +196,59 @@ class Node(objsync.Object):
     def initialize(self):
 
         self.port_list : List[Port] = []
+        self.port_infos = None
+        self.components : List[Component] = []
 
-        # Is the node queueing to run?
-        self.active = False
+        self.added_output = '' # Printed output that isn't sent to output_stream yet
+        self.cancel_reason : Optional[str] = None # Set when the current run is cancelled
         self.color = objsync.Attribute(self, 'color', 'Vector3',v3(*config.get_color(self.category)))
         self.state = objsync.Attribute(self, 'state', 'String','0')
         self.output_stream = objsync.StreamAttribute(self, 'output_stream', 'Stream','')
     
     ## Core methods ------------------------------
 
-    def attempt_to_activate(self):
+    # Priorities in the space's run queue. Runs started by the client (double click) use interactive_priority,
+    # so they run before queued background work like loops.
+    priority = 0
+    interactive_priority = 10
+
+    # Seconds a run may take before it is cancelled. None to use the space's Env.node_time_limit.
+    time_limit : Optional[float] = None
+
+    def attempt_to_activate(self, *, priority = None):
         if self.is_ready() and not self.space.lock_deque:
-            self.activate()
+            self.activate(priority = priority)
 
-    def activate(self):
+    def activate(self, *, priority = None):
         '''
         Call this to enqueue the node in space.
         Later, space will call _run() of this node
         '''
         self.space : Env
-        if self.active: 
-            return # prevent duplication in space.nodes_to_run
-        self.active = True
-        self.space.add_to_deque(self) # It's normally working in LIFO order, but manual activation by client can be FIFO.
-        
-        self.state.set(1)
+        if priority is None:
+            priority = self.priority
+        # The run queue keeps a node once, only moving it up to a higher priority. A running node is queued to run again.
+        # The order of nodes of the same priority is Env.run_policy.
+        if self.space.add_to_deque(self, priority) and not self.space.run_queue.is_running(self):
+            self.state.set(1)
 
     def deactivate(self):
-        self.active = False
-
-        self.state.set(0)
+        # Still shown as queued if it was activated again while running
+        self.state.set(1 if self.space.is_queued(self) else 0)
 
     @final
     def run(self):
         # space calls this method
         self.state.set(2) # 2 means "running"
         self.output_stream.clear()
+        self.cancel_reason = None
 
         # Redirect printed outputs and error messages to client
         with stdoutIO(self): #TODO: optimize this
             try:
                 self.run_node()
+            except NodeCancelled:
+                self.cancelled()
             except Exception:
                 self.running_finished(False)
                 self.output_stream.add(traceback.format_exc())
@@ -186,6 +257,93 @@ class Node(objsync.Object):
                 self.running_finished(True)  
 
 
+    ## Parallel execution ------------------------------
+
+    # Whether the node's work can run on the space's worker pool (see Env.executor). Such a node implements prepare_run()
+    # and finish_run(), and its run_node() should be finish_run(func(*args)) with (func, args) from prepare_run().
+    parallel = False
+
+    def prepare_run(self):
+        '''
+        Gather the inputs on the space thread. Returns (func, args): func(*args) is the work to run on the pool.
+        func must not touch the space, and must be picklable for a process pool (like a function defined at module level).
+        '''
+        raise NotImplementedError()
+
+    def finish_run(self, result):
+        '''
+        Send the result of func(*args) to the outputs, on the space thread.
+        '''
+        raise NotImplementedError()
+
+    @final
+    def start_parallel_run(self, submit):
+        '''
+        Env calls this instead of run() for parallel nodes. submit(func, *args) hands the work to the pool and returns a Future.
+        Returns the Future, or None if gathering the inputs failed.
+        '''
+        self.state.set(2) # 2 means "running"
+        self.output_stream.clear()
+        self.cancel_reason = None
+        with stdoutIO(self):
+            try:
+                func, args = self.prepare_run()
+            except NodeCancelled:
+                self.cancelled()
+                return None
+            except Exception:
+                self.running_finished(False)
+                self.output_stream.add(traceback.format_exc())
+                self.flush_output()
+                return None
+        if func is cached_result:
+            # Nothing to run on the pool
+            future = Future()
+            future.set_result((cached_result(*args), ''))
+            return future
+        return submit(capture_output, func, *args)
+
+    @final
+    def finish_parallel_run(self, future):
+        '''
+        Env calls this on the space thread when the work of start_parallel_run() is done.
+        '''
+        with stdoutIO(self):
+            try:
+                self.check_cancelled()
+                try:
+                    result, output = future.result()
+                except Exception as e:
+                    print(getattr(e, 'node_output', ''), end = '')
+                    raise
+                print(output, end = '')
+                self.finish_run(result)
+            except NodeCancelled:
+                self.cancelled()
+            except Exception:
+                self.running_finished(False)
+                self.output_stream.add(traceback.format_exc())
+                self.flush_output()
+            else:
+                self.running_finished(True)
+
+    ## Cancellation ------------------------------
+
+    def check_cancelled(self):
+        '''
+        Long-running node code can call this to stop as soon as the run is cancelled.
+        '''
+        if self.cancel_reason is not None:
+            raise NodeCancelled()
+
+    def cancelled(self):
+        '''
+        Called when a run is cancelled.
+        '''
+        self.running_finished(False)
+        self.output_stream.add(f'{self.cancel_reason or "Cancelled"}\n')
+        self.flush_output()
+
     ## Backward signal ------------------------------
 
     def is_ready(self):
@@ -232,19 +390,22 @@ class Node(objsync.Object):
         self.output_stream.add(self.added_output)
         self.added_output = ''
 
-    def recive_message(self,m):
+    def recieve_message(self,m,ws):
         '''
-        {'id',command' : 'act'}
-        {'id',command' : 'atr', 'name', 'value'}
+        {'id',command' : 'double click'}
         '''
-        super().recive_message(m)
+        super().recieve_message(m,ws)
         command = m['command']
                     
         if command == "double click":
             self.On_double_click()
 
+    def OnDestroy(self):
+        super().OnDestroy()
+        self.space.dequeue(self)
+
     def On_double_click(self):
-        self.attempt_to_activate()
+        self.attempt_to_activate(priority = self.interactive_priority)
 
 class TestNode(Node):
     pass
@@ -274,7 +435,7 @@ class CodeNode(Node):
 
     def run_node(self):
 
-        exec_(self.code.value,self.space.globals,self.space.locals)
+        self.space.execute(self.code.value)
 
     def running_finished(self, success = True):
         self.flush_output()
@@ -305,7 +466,7 @@ class EvalAssignNode(Node):
 
     def require_value(self):
         if self.block_backward.value or not self.is_ready():
-            self.value = eval(self.code.value,self.space.globals,self.space.locals)
+            self.value = self.space.evaluate(self.code.value)
             for flow in self.out_data.flows:
                 flow.recive_value(self.value)
         else:
@@ -324,9 +485,9 @@ class EvalAssignNode(Node):
                 for flow in self.in_data.flows:
                     self.value.append(flow.get_value())
             #exec_(self.objsync.Attributes['code'] + " = __value", self.space.globals, {'__value' : self.value})
-            self.space.globals.update({self.code.value: self.value})
+            self.space.assign(self.code.value,self.value)
         else:
-            self.value = eval(self.code.value,self.space.globals,self.space.locals)
+            self.value = self.space.evaluate(self.code.value)
         
 
     def running_finished(self, success = True):
@@ -336,6 +497,12 @@ class EvalAssignNode(Node):
                 flow.recive_value(self.value)
         self.deactivate()
         
+def cached_result(result):
+    '''
+    The work of a FunctionNode run whose result is in the cache.
+    '''
+    return result
+
 class FunctionNode(Node):
     '''
     A FunctionNode defines a function.
@@ -369,6 +536,8 @@ class FunctionNode(Node):
         if self.max_in_data == []:
             self.max_in_data = [1]*len(self.in_names)
 
+        self.cache_key = None # Key of the running work's result in the space's result cache, if it will be cached
+
         # Initialize ports from self.in_names, self.out_names and self.max_in_data
         self.in_data = [Port(self,'DataPort',True,name = port_name,max_connections= max_in_data,
          on_edge_activate = self.in_data_activate, pos= pos)for (port_name,max_in_data,pos) in zip(self.in_names,self.max_in_data,in_port_pos)]
@@ -388,7 +557,18 @@ class FunctionNode(Node):
     def in_data_activate(self,port):
         self.attempt_to_activate()
 
+    # function() is a static method that only sees its inputs, so it can run on the worker pool
+    parallel = True
+
+    # Whether to reuse the result of an earlier run of function() with the same inputs, from the space's result cache (see
+    # cache.py). Only for a function that always returns the same result for the same inputs and doesn't modify them.
+    memoize = False
+
     def run_node(self):
+        func, args = self.prepare_run()
+        self.finish_run(func(*args))
+
+    def prepare_run(self):
 
         # Gather data from input dataFlows
         funcion_input = []
@@ -401,9 +581,26 @@ class FunctionNode(Node):
             else:
                 # Gather inpute data into a list
                 funcion_input.append([flow.get_value() for flow in port.flows])
-        
-        # Evaluate the function
-        result = self.function(*funcion_input)
+
+        self.cache_key = None
+        if self.memoize:
+            try:
+                self.cache_key = (self.function, fingerprint(funcion_input))
+            except TypeError:
+                self.space.result_cache.uncacheable += 1
+            else:
+                hit, result = self.space.result_cache.get(self.cache_key)
+                if hit:
+                    self.cache_key = None
+                    return cached_result, [result]
+
+        return self.function, funcion_input
+
+    def finish_run(self, result):
+
+        if self.cache_key is not None:
+            self.space.result_cache.put(self.cache_key, result)
+            self.cache_key = None
 
         # Send data to output dataFlows
         if len(self.out_data) == 1:
@@ -22,7 +22,7 @@ class ForNode(Node):
     def On_double_click(self):
         if (len(self.iterator_port.flows)==1 and self.iterator_port.flows[0].is_ready()):
             self.set_iterator()
-            self.activate()
+            self.activate(priority = self.interactive_priority)
 
     def run_node(self):
         
@@ -71,7 +71,7 @@ class WhileNode(Node):
 
     def On_double_click(self):
         if (len(self.condition_port.flows)==1 and self.condition_port.flows[0].is_ready()):
-            self.activate()
+            self.activate(priority = self.interactive_priority)
 
     def run_node(self):
 
@@ -0,0 +1,75 @@
+from __future__ import annotations
+from typing import Callable, Dict, Iterable, List, Optional
+
+class AncestryIndex:
+    '''
+    Keeps the depth and the ancestor jump table of every object in a space, so the lowest common ancestor of two objects
+    is found in O(log depth) (binary lifting).
+
+    jumps[id][k] is the 2^k-th ancestor of the object. The tables are updated when objects are created, destroyed or moved,
+    which costs O(log depth) per object (for a move, per object in the moved subtree).
+    '''
+    def __init__(self):
+        self.depth : Dict[str,int] = {}
+        self.jumps : Dict[str,List[str]] = {}
+
+    def add(self, id : str, parent_id : Optional[str]):
+        '''
+        Add an object whose parent is already in the index. parent_id is None for the root object.
+        '''
+        if parent_id is None:
+            self.depth[id] = 0
+            self.jumps[id] = []
+            return
+        self.depth[id] = self.depth[parent_id] + 1
+        jumps = [parent_id]
+        while True:
+            above = self.jumps[jumps[-1]]
+            if len(above) < len(jumps):
+                break
+            jumps.append(above[len(jumps) - 1])
+        self.jumps[id] = jumps
+
+    def remove(self, id : str):
+        self.depth.pop(id, None)
+        self.jumps.pop(id, None)
+
+    def move(self, id : str, parent_id : str, children : Callable[[str], Iterable[str]]):
+        '''
+        Update the tables of an object and its descendants after the object is moved under parent_id.
+        children(id) returns the ids of an object's children.
+        '''
+        pending = [(id, parent_id)]
+        while pending:
+            id, parent_id = pending.pop()
+            self.add(id, parent_id)
+            pending.extend((child, id) for child in children(id))
+
+    def parent(self, id : str) -> Optional[str]:
+        jumps = self.jumps[id]
+        return jumps[0] if jumps else None
+
+    def lca(self, a : str, b : str) -> str:
+        '''
+        The lowest common ancestor of two objects. An object counts as its own ancestor.
+        '''
+        if self.depth[a] < self.depth[b]:
+            a, b = b, a
+
+        # Lift a to the depth of b
+        diff = self.depth[a] - self.depth[b]
+        k = 0
+        while diff:
+            if diff & 1:
+                a = self.jumps[a][k]
+            diff >>= 1
+            k += 1
+        if a == b:
+            return a
+
+        # Lift both to just below their lowest common ancestor
+        for k in reversed(range(len(self.jumps[a]))):
+            if k < len(self.jumps[a]) and self.jumps[a][k] != self.jumps[b][k]:
+                a = self.jumps[a][k]
+                b = self.jumps[b][k]
+        return self.jumps[a][0]
@@ -0,0 +1,98 @@
+from __future__ import annotations
+from typing import Dict, Iterable, Iterator, List, Optional
+
+class ChildIndex:
+    '''
+    The ids of an object's children in order. It is used like a list of ids, but `in`, append() and remove() don't scan it.
+
+    Each id takes the next slot of an append-only slot list and a removed id leaves a hole, so the order of the rest never
+    changes. A Fenwick tree over the occupied slots gives the position of an id (index()) or the id at a position
+    (self[i]) in O(log n). The holes are compacted away once they are more than half of the slots.
+    '''
+    def __init__(self, ids : Iterable[str] = ()):
+        self.slots : Dict[str,int] = {}
+        self.ids : List[Optional[str]] = []
+        self.tree : List[int] = [0] # 1-based Fenwick tree. tree[i] counts the occupied slots in (i - lowbit(i), i]
+        for id in ids:
+            self.append(id)
+
+    def prefix_count(self, n : int) -> int:
+        '''
+        Number of occupied slots among the first n.
+        '''
+        count = 0
+        while n > 0:
+            count += self.tree[n]
+            n &= n - 1
+        return count
+
+    def append(self, id : str):
+        if id in self.slots:
+            raise ValueError(f'{id} is already a child')
+        self.slots[id] = len(self.ids)
+        self.ids.append(id)
+        n = len(self.ids)
+        self.tree.append(1 + self.prefix_count(n - 1) - self.prefix_count(n - (n & -n)))
+
+    def remove(self, id : str):
+        slot = self.slots.pop(id) # KeyError like list.remove's ValueError
+        self.ids[slot] = None
+        n = slot + 1
+        while n < len(self.tree):
+            self.tree[n] -= 1
+            n += n & -n
+        if len(self.ids) > 32 and len(self.slots) * 2 < len(self.ids):
+            self.compact()
+
+    def compact(self):
+        ids = [id for id in self.ids if id is not None]
+        self.slots = {}
+        self.ids = []
+        self.tree = [0]
+        for id in ids:
+            self.append(id)
+
+    def index(self, id : str) -> int:
+        '''
+        The position of the child in the order.
+        '''
+        return self.prefix_count(self.slots[id] + 1) - 1
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return list(self)[position]
+        if position < 0:
+            position += len(self.slots)
+        if not 0 <= position < len(self.slots):
+            raise IndexError('child position out of range')
+
+        # Find the slot with position + 1 occupied slots up to and including it
+        n = 0
+        remaining = position + 1
+        step = 1 << (len(self.ids).bit_length())
+        while step:
+            if n + step < len(self.tree) and self.tree[n + step] < remaining:
+                n += step
+                remaining -= self.tree[n]
+            step >>= 1
+        return self.ids[n]
+
+    def __contains__(self, id) -> bool:
+        return id in self.slots
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def __iter__(self) -> Iterator[str]:
+        return (id for id in self.ids if id is not None)
+
+    def __reversed__(self) -> Iterator[str]:
+        return (id for id in reversed(self.ids) if id is not None)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, ChildIndex):
+            other = list(other)
+        return list(self) == other
+
+    def __repr__(self):
+        return f'ChildIndex({list(self)})'
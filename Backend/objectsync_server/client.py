@@ -0,0 +1,130 @@
+from __future__ import annotations
+from typing import List, Optional, Tuple, Union
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from objectsync_server.space import Space
+import asyncio
+import time
+import websockets
+from .codec import MsgpackCodec, msgpack_array_header
+
+class ResyncPoint:
+    '''
+    The space puts this in its outbox right before the snapshot that resyncs a client (see Client.on_overflow). Messages to
+    the client that were put in the outbox before it are stale, so the client drops them until it arrives.
+    '''
+
+class Client:
+    '''
+    A websocket client connected to a space.
+
+    Every client has its own bounded queue of encoded messages and its own sender task, so a slow or stalled client
+    only delays itself. When the queue is full, overflow_policy decides what happens to the client:
+        'drop' - close the connection
+        'resync' - discard the queued messages and send the client a fresh snapshot of the space
+    '''
+
+    # Messages queued within batch_interval seconds (up to max_batch_size of them or max_frame_size) are sent together.
+    # The outbox already delivers messages in batches, so by default this only collects what is queued when the sender wakes up.
+    batch_interval = 0
+    max_batch_size = 1024
+    max_frame_size = 1 << 20 # bytes. A frame ends at the first message that reaches it.
+
+    max_queue_size = 10000
+    overflow_policy = 'resync'
+
+    def __init__(self, ws : websockets.legacy.server.WebSocketServerProtocol, space : Space, version : int, codec : Optional[MsgpackCodec] = None):
+        self.ws = ws
+        self.space = space
+        self.version = version # Wire protocol version. See PROTOCOL_VERSIONS in server.py
+        self.codec = codec # The space's msgpack codec if the client uses the msgpack encoding, None for JSON
+        self.encoding = 'msgpack' if codec is not None else 'json'
+        self.queue : asyncio.Queue[Tuple[Union[str,bytes], float]] = asyncio.Queue()
+        self.resyncing = False # Between an overflow and its ResyncPoint
+        self.sender_task : Optional[asyncio.Task] = asyncio.create_task(self.sender_loop())
+        self.put_names()
+
+    @property
+    def wire_format(self):
+        '''
+        Clients with the same wire format can share encoded messages.
+        '''
+        return (self.encoding, self.version >= 2)
+
+    def put_names(self):
+        '''
+        Send the whole intern table to a msgpack client.
+        '''
+        if self.codec is not None:
+            self.queue.put_nowait((self.codec.encode_names(), time.perf_counter()))
+
+    def put(self, encoded : Union[str,bytes], enqueue_time : float):
+        '''
+        Queue an encoded message to be sent to the client. enqueue_time is when the space put the message in its outbox.
+        '''
+        if self.sender_task is None or self.resyncing:
+            return
+        if self.queue.qsize() >= self.max_queue_size:
+            self.on_overflow()
+            return
+        self.queue.put_nowait((encoded, enqueue_time))
+
+    def on_overflow(self):
+        # Messages that are already queued are stale once the client falls this far behind
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+        if self.overflow_policy == 'resync':
+            print(f'Client of {self.space.name} falls behind. Resyncing')
+            # Until the snapshot, messages are dropped: they are already in the outbox or on the way, and the snapshot
+            # includes their changes
+            self.resyncing = True
+            def resync():
+                self.space.send_message(ResyncPoint(), self.ws)
+                self.space.send_snapshot(self.ws, chunked = self.version >= 3)
+            self.space.post(resync)
+        else:
+            print(f'Client of {self.space.name} falls behind. Dropping')
+            self.close()
+            asyncio.create_task(self.ws.close(1013, 'client falls behind'))
+
+    def end_resync(self):
+        '''
+        Called when the ResyncPoint arrives. The snapshot comes next.
+        '''
+        self.resyncing = False
+        self.put_names()
+
+    def close(self):
+        if self.sender_task is not None:
+            self.sender_task.cancel()
+            self.sender_task = None
+
+    async def sender_loop(self):
+        '''
+        The async loop that sends the queued messages to the client.
+        Messages are collected for one batch tick and sent as one frame (protocol v2) or one frame per message (protocol v1).
+        A msgpack frame is an array of the messages.
+        '''
+        try:
+            while True:
+                batch : List[Tuple[Union[str,bytes], float]] = [await self.queue.get()]
+                size = len(batch[0][0])
+                await asyncio.sleep(self.batch_interval)
+                while len(batch) < self.max_batch_size and size < self.max_frame_size and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    size += len(batch[-1][0])
+
+                if self.encoding == 'msgpack':
+                    await self.ws.send(msgpack_array_header(len(batch)) + b''.join(encoded for encoded, _ in batch))
+                elif self.version >= 2:
+                    await self.ws.send('[' + ','.join(encoded for encoded, _ in batch) + ']')
+                else:
+                    for encoded, _ in batch:
+                        await self.ws.send(encoded)
+
+                if self.space.outbox is not None:
+                    for _, enqueue_time in batch:
+                        self.space.outbox.record_latency(enqueue_time)
+        except websockets.exceptions.ConnectionClosed:
+            pass
@@ -0,0 +1,188 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Tuple
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Encodings a client can ask for in the url, after the protocol version: /space/{space_name}/v2+msgpack
+ENCODINGS = ('json', 'msgpack')
+
+# Short codes of the server -> client commands in the msgpack encoding
+COMMAND_CODES = {
+    'create' : 1,
+    'destroy' : 2,
+    'attribute' : 3,
+    'new attribute' : 4,
+    'delete attribute' : 5,
+    'stream add' : 6,
+    'stream clear' : 7,
+    'load' : 8,
+    'space_metadata' : 9,
+    'load chunk' : 10,
+    'load complete' : 11,
+}
+
+# Msgpack extension types
+VECTOR3 = 1 # Three little-endian float32: x, y, z
+
+# The keys of the protocol's dictionaries (messages, object serializations and attribute serializations). They are interned
+# when the table is created, so their codes never change. Other keys are sent as strings.
+PROTOCOL_KEYS = ['command', 'id', 'name', 'value', 'd', 'type', 'frontend_type', 'attributes', 'children',
+    'history_object', 'root_object', 'types', 'objects']
+
+# Attribute names interned when the table is created
+COMMON_NAMES = ['parent_id']
+
+class JSONText:
+    '''
+    A value together with its compact JSON text. Encoders splice the text into the message instead of encoding the value again.
+    '''
+    def __init__(self, value, text : str):
+        self.value = value
+        self.text = text
+
+class TypedValue:
+    '''
+    An attribute value in a message, together with the attribute's declared type, so the msgpack encoding can pack it by
+    its type. JSON encodes it as the value.
+    '''
+    def __init__(self, value, type : str):
+        self.value = value
+        self.type = type
+
+def encode_json(message, compact = True) -> str:
+    '''
+    Encode a message in JSON. JSONText values at the top level of a compact message are spliced in as they are.
+    '''
+    if not compact:
+        return json.dumps(message, indent=4, default=lambda o: o.value)
+    if isinstance(message, dict) and any(isinstance(v, JSONText) for v in message.values()):
+        return '{' + ','.join(json.dumps(k) + ':' + (v.text if isinstance(v, JSONText) else encode_json(v)) for k, v in message.items()) + '}'
+    return json.dumps(message, separators=(',',':'), default=lambda o: o.value)
+
+def available_encodings():
+    return [e for e in ENCODINGS if e != 'msgpack' or msgpack is not None]
+
+class MsgpackCodec:
+    '''
+    Encodes server -> client messages in the compact binary encoding. A space has one codec shared by all its msgpack clients,
+    so every message is still encoded only once.
+
+    - The value of "command" is replaced by its code in COMMAND_CODES.
+    - The keys of messages and of object and attribute serializations (PROTOCOL_KEYS), and attribute names (the "name"
+      field and the keys of "attributes") are interned: they are sent as integer codes. The codes are defined by intern
+      messages, [first code, [name, name, ...]], which are sent to all msgpack clients of the space before the first
+      message that uses them.
+    - Values of Vector3 attributes are packed into a VECTOR3 extension.
+    Anything else, like a dictionary in an attribute value, is sent as it is.
+    '''
+    def __init__(self):
+        assert msgpack is not None, 'msgpack is not installed'
+        self.names : Dict[str,int] = {}
+        self.new_names : List[str] = []
+        for name in PROTOCOL_KEYS + COMMON_NAMES:
+            self.intern(name)
+        self.new_names = []
+
+    def intern(self, name : str) -> int:
+        code = self.names.get(name)
+        if code is None:
+            code = self.names[name] = len(self.names)
+            self.new_names.append(name)
+        return code
+
+    def key(self, key):
+        return self.names[key] if key in PROTOCOL_KEYS else key
+
+    def compact(self, message) -> Any:
+        message = unwrap(message)
+        if not isinstance(message, dict):
+            return plain(message)
+        result = {}
+        for k, v in message.items():
+            if k == 'command' and v in COMMAND_CODES:
+                v = COMMAND_CODES[v]
+            elif k == 'name' and isinstance(v, str):
+                v = self.intern(v)
+            elif k in ('d', 'root_object'):
+                v = self.compact_object(v)
+            elif k == 'objects':
+                v = [self.compact_object(d) for d in unwrap(v)]
+            elif k == 'value':
+                # "new attribute" has the attribute's type, "attribute" has a TypedValue
+                v = compact_value(v, message.get('type'))
+            else:
+                v = plain(v)
+            result[self.key(k)] = v
+        return result
+
+    def compact_object(self, d : Dict[str,Any]) -> Dict:
+        result = {}
+        for k, v in unwrap(d).items():
+            if k == 'attributes':
+                v = {self.intern(name) : {self.key(ak) : compact_value(av, attr.get('type')) if ak == 'value' else plain(av) for ak, av in attr.items()}
+                    for name, attr in v.items()}
+            elif k == 'children':
+                v = [self.compact_object(child) for child in v]
+            else:
+                v = plain(v)
+            result[self.key(k)] = v
+        return result
+
+    def encode(self, message) -> Tuple[bytes, List[str]]:
+        '''
+        Returns the encoded message and the names it newly interned. The caller must send the definition of the new names
+        (see encode_names()) before the message.
+        '''
+        packed = msgpack.packb(self.compact(message), use_bin_type=True)
+        new_names, self.new_names = self.new_names, []
+        return packed, new_names
+
+    def encode_names(self, names : List[str] = None) -> bytes:
+        '''
+        Encode an intern message that defines names. Defines the whole table if names is None.
+        '''
+        if names is None:
+            names = list(self.names.keys())
+        return msgpack.packb([self.names[names[0]] if names else 0, names], use_bin_type=True)
+
+def unwrap(value):
+    if isinstance(value, (JSONText, TypedValue)):
+        return value.value
+    return value
+
+def plain(value):
+    '''
+    A value with the JSONText and TypedValue in it replaced by their values.
+    '''
+    value = unwrap(value)
+    if isinstance(value, dict):
+        return {k : plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    return value
+
+def compact_value(value, type : str = None):
+    '''
+    Pack an attribute value by the attribute's type.
+    '''
+    if isinstance(value, TypedValue):
+        type = value.type
+    value = unwrap(value)
+    if type == 'Vector3' and isinstance(value, dict) and all(isinstance(value.get(k), (int, float)) for k in 'xyz'):
+        return msgpack.ExtType(VECTOR3, struct.pack('<3f', value['x'], value['y'], value['z']))
+    return plain(value)
+
+def msgpack_array_header(length : int) -> bytes:
+    '''
+    The msgpack header of an array, so already encoded items can be joined into an array without decoding them.
+    '''
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 0x10000:
+        return b'\xdc' + struct.pack('>H', length)
+    return b'\xdd' + struct.pack('>I', length)
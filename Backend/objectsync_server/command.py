@@ -4,12 +4,17 @@ from typing import TYPE_CHECKING, Optional, Any
 if TYPE_CHECKING:
     from objectsync_server import Space, Object
 
+from objectsync_server.payload import Payload, estimate_value_size
+
+import sys
 import time
 
 class Command(ABC):
     '''
     Implements the command pattern.
     '''
+    __slots__ = ('done', 'space', 'history_obj')
+
     def __init__(self,space :Optional[Space] = None):
         '''
         history_in: Where to push the command in history
@@ -27,6 +32,9 @@ class Command(ABC):
         self.done = True
         if self.space != None and push and self.history_obj != "none":
             self.space.command_manager.push(self)
+        elif self.space != None:
+            # Commands that skip history are not flushed, so log them here
+            self.space.log_command(self)
 
     @abstractmethod
     def redo(self):
@@ -36,15 +44,29 @@ class Command(ABC):
     def undo(self):
         self.done = False
 
+    def log_records(self, undo = False) -> list[dict]:
+        '''
+        The operation log records (see wal.py) of the changes made by executing/redoing the command, or by undoing it if undo is True.
+        '''
+        return []
+
+    def estimate_size(self) -> int:
+        '''
+        Estimated bytes held by the command. Histories use it to stay within their budgets.
+        '''
+        return sys.getsizeof(self) + (sys.getsizeof(self.__dict__) if hasattr(self,'__dict__') else 0)
+
 class CommandSequence(Command):
     '''
     Represents a sequence of commands that the commands should be executed successively (and not apart).
     '''
+    __slots__ = ('commands',)
+
     def __init__(self, commands:list[Command]):
         super().__init__()
         self.commands = commands
         space = commands[0].space
-        self.history_obj = get_co_ancestor([space[c.history_obj] for c in self.commands]).id
+        self.history_obj = get_co_ancestor([space.command_manager.live_history_obj(c) for c in self.commands]).id
         self.done = True
         
     def execute(self):
@@ -66,6 +88,15 @@ class CommandSequence(Command):
             command.undo()
         self.done = False
 
+    def log_records(self, undo = False):
+        records = []
+        for command in (reversed(self.commands) if undo else self.commands):
+            records += command.log_records(undo)
+        return records
+
+    def estimate_size(self):
+        return super().estimate_size() + sum(command.estimate_size() for command in self.commands)
+
     def __str__(self):
         res = "Sequence: " 
         for command in self.commands:
@@ -76,6 +107,8 @@ class CommandHead(Command):
     '''
     A placeholder that serves as the first HistoryItem in the History linked list.
     '''
+    __slots__ = ()
+
     def __init__(self,space = None):
         super(CommandHead,self).__init__(space)
         self.done = True
@@ -96,42 +129,62 @@ class CommandCreate(Command):
     '''
     Creation of a new object.
     '''
-    def __init__(self,space:Space,d:dict[str,Any],parent:str):
+    __slots__ = ('d', 'id', 'parent', 'is_new', 'payload')
+
+    def __init__(self,space:Space,d:dict[str,Any],parent:str,is_new = True):
+        '''
+        is_new: Whether d is a new object to build (see Space.create()), or a complete serialization, like a copy of another object
+        '''
         super().__init__(space)
         self.space = space
         self.d = d
+        self.id = d['id']
         self.parent = parent
+        self.is_new = is_new
+        self.payload : Optional[Payload] = None
 
         self.history_obj = self.space[parent].id
 
     def execute(self):
         super().execute()
-        new_instance = self.space.create(self.d, is_new = True, parent=self.parent)
-        self.d = new_instance.serialize()
+        new_instance = self.space.create(self.d, is_new = self.is_new, parent=self.parent)
+        self.d = None
+        self.payload = Payload(new_instance)
 
     def redo(self):
         super().redo()
-        self.space.create(self.d, is_new = False,parent=self.parent)
-        self.d = self.space[self.d['id']].serialize()
+        self.space.create(self.payload.get(), is_new = False,parent=self.parent)
+        self.payload = Payload(self.space[self.id])
 
     def undo(self):
         ''' 
         Serialize the object before destroying so it can be recover using redo().
         '''
         super().undo()
-        self.d = self.space[self.d['id']].serialize()
-        self.space.destroy(self.d['id'])
+        self.payload = Payload(self.space[self.id])
+        self.space.destroy(self.id)
+
+    def log_records(self, undo = False):
+        if undo:
+            return [{'op':'destroy','id':self.id}]
+        return [{'op':'create','d':self.payload.get()}]
+
+    def estimate_size(self):
+        return super().estimate_size() + (self.payload.estimate_size() if self.payload is not None else 0)
 
     def __str__(self):
-        return f"Create {self.d['id']}"
+        return f"Create {self.id}"
 
 class CommandDestroy(Command):
     '''
     Destruction of an object.
     '''
+    __slots__ = ('id', 'parent', 'payload')
+
     def __init__(self,space:Space,id:str):
         super().__init__(space)
         self.id = id
+        self.payload : Optional[Payload] = None
         assert self.space != None
 
         self.history_obj = self.space[self.id].parent_id.value
@@ -139,26 +192,36 @@ class CommandDestroy(Command):
     def execute(self):
         super().execute()
         self.parent = self.space[self.id].parent_id.value
-        self.d = self.space[self.id].serialize()
+        self.payload = Payload(self.space[self.id])
         self.space.destroy(self.id)
 
     def redo(self):
         super().redo()
         self.parent = self.space[self.id].parent_id.value
-        self.d = self.space[self.id].serialize()
+        self.payload = Payload(self.space[self.id])
         self.space.destroy(self.id)
 
     def undo(self):
         super().undo()
-        self.space.create(self.d, is_new = False, parent=self.parent)
+        self.space.create(self.payload.get(), is_new = False, parent=self.parent)
+
+    def log_records(self, undo = False):
+        if undo:
+            return [{'op':'create','d':self.payload.get()}]
+        return [{'op':'destroy','id':self.id}]
+
+    def estimate_size(self):
+        return super().estimate_size() + (self.payload.estimate_size() if self.payload is not None else 0)
 
     def __str__(self):
-        return f"Destroy {self.d['id']}"
+        return f"Destroy {self.id}"
 
 class CommandAttribute(Command):
     '''
     Change of an attribute value.
     '''
+    __slots__ = ('name', 'new_value', 'obj', 'time', 'old_value')
+
     def __init__(self,space:Space,obj:str,name:str,new_value,history_obj:Optional[str] = None):
         super().__init__()
         self.name = name            
@@ -182,6 +245,12 @@ class CommandAttribute(Command):
         super().undo()
         self.space[self.obj].attributes[self.name].set(self.old_value)
 
+    def log_records(self, undo = False):
+        return [{'op':'attribute','id':self.obj,'name':self.name,'value':self.old_value if undo else self.new_value}]
+
+    def estimate_size(self):
+        return super().estimate_size() + estimate_value_size(getattr(self,'old_value',None)) + estimate_value_size(self.new_value)
+
     def __str__(self):
         return f"Attribute {self.obj} {self.name} old: {self.old_value} new: {self.new_value}"
 
@@ -196,12 +265,43 @@ class CommandManager():
     def __init__(self,space:Space):
         self.space = space
         self.collected_commands : list[Command] = []
+        self.destroyed_parents : dict[str,str] = {} # Objects destroyed while commands are collected -> their parents
+        # Collected commands, and the operation log records of the changes made after them, in the order they were made
+        self.unlogged : list[Command|list[dict]] = []
 
     def push(self,command:Command):
         '''
         Collect a command.
         '''
         self.collected_commands.append(command)
+        self.unlogged.append(command)
+
+    def log(self,records:list[dict]):
+        '''
+        Append the records of a change that isn't collected to the operation log. While there are collected commands, the
+        records wait for flush() after them, so replaying the log makes the changes in the order they were made.
+        '''
+        if self.unlogged:
+            self.unlogged.append(records)
+        else:
+            self.space.write_log(records)
+
+    def on_destroy(self,id:str,parent_id:str):
+        '''
+        Called when an object is destroyed, so collected commands whose history object it is can still be stored.
+        '''
+        if self.collected_commands:
+            self.destroyed_parents[id] = parent_id
+
+    def live_history_obj(self,command:Command) -> Object:
+        '''
+        The command's history object, or its nearest ancestor that still exists if it was destroyed after the command
+        (like in a batch that creates an object and then destroys its parent).
+        '''
+        id = command.history_obj
+        while id not in self.space.objs:
+            id = self.destroyed_parents[id]
+        return self.space[id]
 
     def flush(self):
         '''
@@ -209,43 +309,55 @@ class CommandManager():
         '''
         if len(self.collected_commands) == 0:
             return
-        if len(self.collected_commands) == 1:
-            command = self.collected_commands[0]
-        else:
-            command = CommandSequence(self.collected_commands)
-
-        storage_obj = self.space[command.history_obj]
-
-        # don't repeat atr history within 2 seconds 
-        last_command = storage_obj.history.current.command
-        if isinstance(command ,CommandAttribute) and isinstance(last_command,CommandAttribute) and command.obj == last_command.obj and command.name == last_command.name:
-            if (command.time - last_command.time)<2:
-                last_command.new_value = command.new_value
-                self.collected_commands = []
-                return
-
-        # Push the command to the histories of:
-        # 1. the object that the command is executed on
-        # 2. its ancestors
-        while 1:
-            if storage_obj.catches_command:
-                storage_obj.history.push(command)
-            if not storage_obj.forwards_command:
-                break
-            if storage_obj.parent_id.value == None:
-                break
-            storage_obj = self.space[storage_obj.parent_id.value]
-
-        self.collected_commands = []
+        try:
+            if len(self.collected_commands) == 1:
+                command = self.collected_commands[0]
+            else:
+                command = CommandSequence(self.collected_commands)
+
+            # The collected commands are logged one by one, in order with the changes made between them
+            for entry in self.unlogged:
+                self.space.write_log(entry.log_records() if isinstance(entry,Command) else entry)
+
+            storage_obj = self.live_history_obj(command)
+
+            # don't repeat atr history within 2 seconds after the last change, so a continuous drag is one history item
+            last_command = storage_obj.history.current.command
+            if isinstance(command ,CommandAttribute) and isinstance(last_command,CommandAttribute) and command.obj == last_command.obj and command.name == last_command.name:
+                if (command.time - last_command.time)<2:
+                    last_command.new_value = command.new_value
+                    last_command.time = command.time
+                    return
+
+            # Push the command to the histories of:
+            # 1. the object that the command is executed on
+            # 2. its ancestors
+            while 1:
+                if storage_obj.catches_command:
+                    storage_obj.history.push(command)
+                if not storage_obj.forwards_command:
+                    break
+                if storage_obj.parent_id.value == None:
+                    break
+                storage_obj = self.space[storage_obj.parent_id.value]
+        finally:
+            # Even if storing fails, later flushes start over
+            self.collected_commands = []
+            self.destroyed_parents = {}
+            self.unlogged = []
 
 class HistoryItem:
     '''
     Pack a command into an item of a linked list.
     '''
+    __slots__ = ('command', 'last', 'next', 'history', 'size', 'time')
+
     def __init__(self,command:Command,last=None):
         self.command = command
         self.last : Optional[HistoryItem] = last
         self.next : Optional[HistoryItem] = None
+        self.history : Optional[History] = None # The history the item is in. None once it is evicted or discarded.
+        self.size = command.estimate_size()
 
         if last is not None:
             last.next = self
@@ -256,6 +368,11 @@ class History:
     '''
     Every object has a history. This is a linked list of Commands.
 
+    The history is bounded by its object's history_max_entries and history_max_bytes (estimated with Command.estimate_size()),
+    and the space bounds the items of all histories together (see Space.trim_history()). When a bound is exceeded, the
+    oldest items are compacted (two attribute changes of the same attribute that no other history has are merged into one)
+    or evicted.
+
     methods:
         push(command:Command): Link a new command after the current command.
         undo(): Undo the current command and move the pointer to the previous command.
@@ -264,13 +381,111 @@ class History:
     
     def __init__(self,object:Object):
         self.space = object.space
-        self.current : HistoryItem = HistoryItem(CommandHead())
+        self.max_entries : Optional[int] = object.history_max_entries
+        self.max_bytes : Optional[int] = object.history_max_bytes
+        self.head = HistoryItem(CommandHead())
+        self.current : HistoryItem = self.head
+        self.entries = 0
+        self.bytes = 0
 
     def push(self,command : Command):
         '''
         Link a new command after the current command.
         '''
+        # The undone items after the current one can't be redone anymore
+        item = self.current.next
+        while item is not None:
+            self.forget(item)
+            item = item.next
+
         self.current=HistoryItem(command,self.current)
+        self.current.history = self
+        self.entries += 1
+        self.bytes += self.current.size
+        self.space.on_history_push(self.current)
+
+        while self.over_budget() and self.evict_oldest():
+            pass
+        self.space.trim_history()
+
+    def over_budget(self):
+        return (self.max_entries is not None and self.entries > self.max_entries) or \
+            (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def forget(self,item:HistoryItem):
+        if item.history is not self:
+            return
+        item.history = None
+        self.entries -= 1
+        self.bytes -= item.size
+        self.space.on_history_forget(item)
+
+    def evict_oldest(self):
+        '''
+        Compact or evict the oldest item. Returns False if the history is empty.
+        '''
+        first = self.head.next
+        if first is None:
+            return False
+        second = first.next
+
+        # Merge two changes of the same attribute. Undoing the merged item restores the value before both.
+        # Commands that are in other histories too aren't merged, as those histories would still undo and redo them apart.
+        if second is not None and isinstance(first.command, CommandAttribute) and isinstance(second.command, CommandAttribute) \
+                and first.command.obj == second.command.obj and first.command.name == second.command.name \
+                and first.command.done == second.command.done \
+                and self.space.command_refs[first.command] == 1 and self.space.command_refs[second.command] == 1:
+            merged = CommandAttribute(self.space, first.command.obj, first.command.name, second.command.new_value, first.command.history_obj)
+            merged.old_value = first.command.old_value
+            merged.done = first.command.done
+            merged.time = second.command.time
+            size = merged.estimate_size()
+            self.bytes += size - first.size
+            self.space.history_bytes += size - first.size
+            self.space.release_command(first.command)
+            self.space.command_refs[merged] = 1
+            first.command = merged
+            first.size = size
+
+            first.next = second.next
+            if second.next is not None:
+                second.next.last = first
+            if self.current is second:
+                self.current = first
+            self.forget(second)
+            return True
+
+        if self.current is self.head:
+            # Everything is undone, so the later items can't be redone without the oldest one
+            item = first
+            while item is not None:
+                self.forget(item)
+                item = item.next
+            self.head.next = None
+            return True
+
+        # The change of an evicted item stays applied, it just can't be undone anymore
+        if self.current is first:
+            self.current = self.head
+        self.head.next = second
+        if second is not None:
+            second.last = self.head
+        self.forget(first)
+        return True
+
+    def clear(self):
+        '''
+        Remove all items, e.g. when the object is destroyed.
+        '''
+        item = self.head.next
+        while item is not None:
+            self.forget(item)
+            item = item.next
+        self.head.next = None
+        self.current = self.head
+
+    def stats(self):
+        return {'entries' : self.entries, 'bytes' : self.bytes, 'max_entries' : self.max_entries, 'max_bytes' : self.max_bytes}
 
     def undo(self):
         '''
@@ -287,6 +502,7 @@ class History:
         
         # Perform the undo
         self.current.command.undo()
+        self.space.log_command(self.current.command, undo = True)
 
         self.current.command.done = False
         self.current=self.current.last
@@ -308,6 +524,7 @@ class History:
         
         # Perform the redo
         self.current.command.redo()
+        self.space.log_command(self.current.command)
 
         self.current.command.done = True
         return 1
@@ -326,26 +543,10 @@ class History:
 
 def get_co_ancestor(objs) -> Object:
     '''
-    Returns the lowest common ancestor of multiple objects.
+    Returns the lowest common ancestor of multiple objects. See AncestryIndex.
     '''
     space = objs[0].space
-    min_len = 1000000000000
-    parent_lists = []
-    for o in objs:
-        parent_list = []
-        parent_list.append(o)
-        while o.id != "0":
-            o = o.parent
-            parent_list.append(o)
-        parent_lists.append(list(reversed(parent_list)))
-        min_len = min(len(parent_list), min_len)
-
-    last = space.root_obj
-    for i in range(min_len):
-        current = parent_lists[0][i]
-        for j in range(1,len(parent_lists)):
-            if current != j:
-                return last
-        last = current
-
-    return last
\ No newline at end of file
+    id = objs[0].id
+    for o in objs[1:]:
+        id = space.ancestry.lca(id, o.id)
+    return space[id]
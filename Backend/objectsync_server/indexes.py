@@ -0,0 +1,104 @@
+from __future__ import annotations
+from typing import Any, Dict, Hashable, Iterable, Optional, Set
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from objectsync_server.object import Object
+import json
+
+def index_key(value) -> Hashable:
+    '''
+    The key of an attribute value in an attribute index. Unhashable values (like Vector3 dictionaries) are keyed by their JSON.
+    '''
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return json.dumps(value, sort_keys=True, default=lambda o: o.value)
+
+class ObjectIndexes:
+    '''
+    Secondary indexes of the objects in a space: by class, by frontend_type, and by the value of each attribute in
+    attribute_names. The space updates them when objects are created or destroyed and when attributes change.
+    '''
+    def __init__(self, attribute_names : Iterable[str] = ()):
+        self.by_class : Dict[type,Set[str]] = {}
+        self.by_frontend_type : Dict[str,Set[str]] = {}
+        self.by_attribute : Dict[str,Dict[Hashable,Set[str]]] = {name : {} for name in attribute_names}
+        self.keys : Dict[str,Dict[str,Hashable]] = {} # id -> {attribute name -> indexed key}
+
+    def add(self, obj : Object):
+        self.by_class.setdefault(type(obj), set()).add(obj.id)
+        self.by_frontend_type.setdefault(obj.frontend_type, set()).add(obj.id)
+        self.keys[obj.id] = {}
+        for name, attr in obj.attributes.items():
+            self.set_attribute(obj.id, name, attr.value)
+
+    def remove(self, obj : Object):
+        if obj.id not in self.keys:
+            return
+        for name in list(self.keys[obj.id]):
+            self.remove_attribute(obj.id, name)
+        del self.keys[obj.id]
+        discard(self.by_class, type(obj), obj.id)
+        discard(self.by_frontend_type, obj.frontend_type, obj.id)
+
+    def set_attribute(self, id : str, name : str, value):
+        '''
+        Called when an attribute of an indexed object is added or changed.
+        '''
+        index = self.by_attribute.get(name)
+        if index is None or id not in self.keys:
+            return
+        self.remove_attribute(id, name)
+        key = index_key(value)
+        index.setdefault(key, set()).add(id)
+        self.keys[id][name] = key
+
+    def remove_attribute(self, id : str, name : str):
+        keys = self.keys.get(id)
+        if keys is None or name not in keys:
+            return
+        discard(self.by_attribute[name], keys.pop(name), id)
+
+    def add_attribute_index(self, name : str, objs : Iterable[Object]):
+        '''
+        Start indexing an attribute. objs are the existing objects.
+        '''
+        if name in self.by_attribute:
+            return
+        self.by_attribute[name] = {}
+        for obj in objs:
+            if name in obj.attributes:
+                self.set_attribute(obj.id, name, obj.attributes[name].value)
+
+    def find(self, cls : Optional[type] = None, frontend_type : Optional[str] = None, attributes : Optional[Dict[str,Any]] = None) -> Set[str]:
+        '''
+        Ids of the objects that are instances of cls (including subclasses), have the frontend_type and whose attributes have the
+        given values. Only indexed attributes are looked up here; the caller filters the others.
+        '''
+        candidates : Optional[Set[str]] = None
+
+        def narrow(ids : Set[str]):
+            nonlocal candidates
+            candidates = set(ids) if candidates is None else candidates & ids
+
+        if cls is not None:
+            ids = set()
+            for indexed_class, class_ids in self.by_class.items():
+                if issubclass(indexed_class, cls):
+                    ids |= class_ids
+            narrow(ids)
+        if frontend_type is not None:
+            narrow(self.by_frontend_type.get(frontend_type, set()))
+        for name, value in (attributes or {}).items():
+            if name in self.by_attribute:
+                narrow(self.by_attribute[name].get(index_key(value), set()))
+        return set(self.keys) if candidates is None else candidates
+
+def discard(index : Dict[Hashable,Set[str]], key : Hashable, id : str):
+    ids = index.get(key)
+    if ids is None:
+        return
+    ids.discard(id)
+    if not ids:
+        del index[key]
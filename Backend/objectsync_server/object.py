@@ -1,11 +1,14 @@
 from __future__ import annotations
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 from typing import TYPE_CHECKING
 from xml.dom.minidom import Attr
 if TYPE_CHECKING:
     from objectsync_server.space import Space
 
 from objectsync_server.command import History, CommandAttribute, get_co_ancestor
+from objectsync_server.codec import JSONText, TypedValue
+from objectsync_server.children import ChildIndex
+import json
 
 class Attribute:
     '''
@@ -14,8 +17,11 @@ class Attribute:
     Attributes are states of object, they can be string, float or other types. Once an attribute is modified (whether in client or server),
     the server will send "attribute" command to all clients to update the attribute value.
     '''
+    __slots__ = ('obj', 'name', 'type', 'value', 'history_obj', 'callback')
+
     def __init__(self, obj : Object,name,type, value, history_obj:Optional[str] = 'none',callback=None):
         obj.attributes[name]=self
+        obj.invalidate_serialization()
         self.obj = obj
         self.name = name
         self.type = type # string, float, etc.
@@ -25,6 +31,7 @@ class Attribute:
 
         # Called when the attribute is changed.
         self.callback = callback
+        obj.space.indexes.set_attribute(obj.id, name, value)
     
     def set_com(self,value):
         '''
@@ -57,8 +64,11 @@ class Attribute:
         else:
             self.value = value
 
+        self.obj.invalidate_serialization()
+        self.obj.space.indexes.set_attribute(self.obj.id, self.name, self.value)
+
         if send:
-            self.obj.space.send_message({'command':'attribute','id':self.obj.id,'name':self.name,'value':self.value})
+            self.obj.space.send_message({'command':'attribute','id':self.obj.id,'name':self.name,'value':TypedValue(self.value,self.type)})
 
     def serialize(self):
         d = {'type' : self.type, 'value' : self.value,'history_object':self.history_obj}
@@ -68,6 +78,8 @@ class StreamAttribute(Attribute):
     '''
     A special type of attribute that saves traffic
     '''
+    __slots__ = ()
+
     def set_com(self,value):
         raise Exception('StreamAttribute does not support history')
 
@@ -87,9 +99,27 @@ class Object:
     catches_command = True
     forwards_command = True
 
+    # Bounds of the object's history, in items and in estimated bytes. None for no bound. See History.
+    history_max_entries : Optional[int] = 1000
+    history_max_bytes : Optional[int] = 16 << 20
+
+    # Names of attributes whose values are ids of other objects. When objects are cloned together, their references to each other
+    # are changed to the copies. See remap_ids().
+    reference_attributes : Tuple[str,...] = ()
+
+    # Names of attributes whose values the space indexes, so Space.find() can look objects up by them
+    indexed_attributes : Tuple[str,...] = ()
+
     def __init__(self,space : Space, d, is_new=False, parent = None):
         self.space = space
         self.id = d['id']
+
+        # Cached serializations of the subtree and of the object itself. See invalidate_serialization().
+        self.serialization_cache : Optional[Dict[str,Any]] = None
+        self.json_cache : Optional[str] = None
+        self.shallow_cache : Optional[Dict[str,Any]] = None
+        self.shallow_json_cache : Optional[str] = None
+
         self.history = History(self)
         self.history_on = True
         self.attributes : Dict[str,Attribute] = {}
@@ -103,8 +133,9 @@ class Object:
 
         
         self.space.objs.update({self.id:self})
+        self.space.ancestry.add(self.id, self.parent_id.value if self.id != '0' else None)
         
-        self.children_ids = [] # It's already sufficient that parent_id be an attribute.
+        self.children_ids = ChildIndex() # It's already sufficient that parent_id be an attribute.
 
         # Child classes can override this function ( instead of __init__() ) to add attributes or anything the class needs.
         self.initialize()
@@ -141,6 +172,66 @@ class Object:
                 self.space.create(child_dict,parent=self,is_new = False,send=False)
 
     def serialize(self) -> Dict[str,Any]:
+        '''
+        The serialization is cached until the object or its descendants change. It is shared, so don't modify it.
+        '''
+        if self.serialization_cache is None:
+            d = dict(self.serialize_shallow())
+            d["children"] = [self.space[c].serialize() for c in self.children_ids]
+            self.serialization_cache = d
+        return self.serialization_cache
+
+    def serialize_json(self) -> str:
+        '''
+        The serialization in compact JSON. Like serialize(), it is cached, and the cached JSON of the children is spliced in.
+        '''
+        if self.json_cache is None:
+            head = self.serialize_shallow_json()
+            children = ','.join(self.space[c].serialize_json() for c in self.children_ids)
+            self.json_cache = head[:-1] + ',"children":[' + children + ']}'
+        return self.json_cache
+
+    def serialize_shallow(self) -> Dict[str,Any]:
+        '''
+        The serialization without children, cached like serialize().
+        '''
+        if self.shallow_cache is None:
+            self.shallow_cache = self.serialize_fields()
+        return self.shallow_cache
+
+    def serialize_shallow_json(self) -> str:
+        '''
+        serialize_shallow() in compact JSON, cached like serialize().
+        '''
+        if self.shallow_json_cache is None:
+            self.shallow_json_cache = json.dumps(self.serialize_shallow(), separators=(',',':'), default=lambda o: o.value)
+        return self.shallow_json_cache
+
+    def serialize_encoded(self) -> JSONText:
+        '''
+        The serialization together with its JSON, for putting in messages.
+        '''
+        return JSONText(self.serialize(), self.serialize_json())
+
+    def invalidate_serialization(self):
+        '''
+        Clear the cached serializations of the object, and the cached subtree serializations of its ancestors.
+        Call this when anything serialize_fields() reads or the children are changed.
+        A valid subtree cache implies valid subtree caches of all descendants, so the walk stops at the first ancestor without one.
+        '''
+        self.space.revision += 1
+        self.shallow_cache = None
+        self.shallow_json_cache = None
+        obj = self
+        while obj is not None and (obj.serialization_cache is not None or obj.json_cache is not None):
+            obj.serialization_cache = None
+            obj.json_cache = None
+            obj = obj.parent if obj.id != '0' else None
+
+    def serialize_fields(self) -> Dict[str,Any]:
+        '''
+        The serialization of the object itself, without children. Child classes can override this to add fields.
+        '''
         # Do we need to serialize history ?
         d = dict()
         attr_dict = {}
@@ -151,10 +242,29 @@ class Object:
             "type":type(self).__name__,
             'frontend_type' : self.frontend_type,
             "attributes":attr_dict,
-            "children":[self.space[c].serialize() for c in self.children_ids]
             })
         return d
 
+    @classmethod
+    def remap_ids(cls, d : Dict[str,Any], id_map : Dict[str,str]) -> Dict[str,Any]:
+        '''
+        Returns a copy of a serialization for a clone of the object, with the ids in id_map replaced: the object's own id,
+        parent_id, the reference_attributes and the attributes' history_object. Children are remapped by the caller.
+        Child classes that keep object ids elsewhere in their serialization can override this.
+        '''
+        d = dict(d)
+        d['id'] = id_map[d['id']]
+        attributes = {}
+        for name, attr_dict in d.get('attributes', {}).items():
+            attr_dict = dict(attr_dict)
+            if name == 'parent_id' or name in cls.reference_attributes:
+                attr_dict['value'] = id_map.get(attr_dict['value'], attr_dict['value'])
+            if attr_dict.get('history_object') in id_map:
+                attr_dict['history_object'] = id_map[attr_dict['history_object']]
+            attributes[name] = attr_dict
+        d['attributes'] = attributes
+        return d
+
     # Attribute callbacks 
 
     def OnParentChanged(self,old_id,new_id):
@@ -162,8 +272,11 @@ class Object:
         new = self.space[new_id]
         old.children_ids.remove(self.id)
         new.children_ids.append(self.id)
+        old.invalidate_serialization()
+        new.invalidate_serialization()
 
         self.parent = new
+        self.space.ancestry.move(self.id, new_id, lambda id: self.space[id].children_ids)
 
     # --------------------------
 
@@ -178,21 +291,27 @@ class Object:
         if command =='attribute':
             if m['name'] == 'parent_id':
                 self.parent_id.history_obj = get_co_ancestor([self.space[self.parent_id.value],self.space[m['value']]]).id
+                # It is serialized as history_object, even if the value doesn't change
+                self.invalidate_serialization()
             if self.history_on:
                 self.attributes[m['name']].set_com(m['value'])
             else: 
-                self.attributes[m['name']].set(m['value'])
+                CommandAttribute(self.space, self.id, m['name'], m['value'], 'none').execute()
         
         # Add a new attribute
         if command == 'new attribute':
             if m['name'] not in self.attributes:
                 Attribute(self,m['name'],m['type'],m['value'],m['history_object'])
+                self.space.log_record({'op':'new attribute','id':self.id,'name':m['name'],'type':m['type'],'value':m['value'],'history_object':m['history_object']})
                 self.space.send_message(m,exclude_ws=ws)
 
         # Delete an attribute
         if command == 'delete attribute':
             if m['name'] in self.attributes:
                 self.attributes.pop(m['name'])
+                self.space.indexes.remove_attribute(self.id, m['name'])
+                self.invalidate_serialization()
+                self.space.log_record({'op':'delete attribute','id':self.id,'name':m['name']})
                 self.space.send_message(m,exclude_ws=ws)
 
         # Undo
@@ -220,9 +339,11 @@ class Object:
 
     def OnChildCreated(self,child:Object):
         self.children_ids.append(child.id)
+        self.invalidate_serialization()
 
     def OnChildDestroyed(self,child:Object):
         self.children_ids.remove(child.id)
+        self.invalidate_serialization()
 
     def add_child(self,type,d={}):
         d['type']=type
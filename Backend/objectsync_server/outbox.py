@@ -0,0 +1,133 @@
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, Tuple
+from contextlib import contextmanager
+import asyncio
+import threading
+import time
+
+class Outbox:
+    '''
+    Carries messages from the space thread to the asyncio event loop.
+
+    Any thread can put() messages. The buffer is guarded by a short lock, and the event loop is woken up
+    (through call_soon_threadsafe) only once per batch: the first put() after a drain schedules the next drain.
+    The drain hands the whole batch to deliver() on the event loop thread.
+
+    Each buffered entry is (targets, message, enqueue time). The enqueue time is passed on so the sender can
+    report the enqueue-to-send latency with record_latency().
+
+    "attribute" messages are coalesced: while a batch waits for its drain (at least flush_interval seconds), a newer value
+    for the same (object id, attribute name, targets) replaces the buffered one in place. Any other message about the attribute
+    (or about the whole object) ends its coalescing, and "create"/"destroy" end it for all objects, so values never move
+    across the messages they depend on.
+
+    Inside hold(), messages are only buffered. They are drained together after the last hold exits.
+    '''
+    flush_interval = 0.01
+    def __init__(self, loop : asyncio.AbstractEventLoop, deliver : Callable[[List[Tuple[list, Any, float]]], None]):
+        self.loop = loop
+        self.deliver = deliver
+        self.buffer : List[Tuple[list, Any, float]] = []
+        self.pending_attributes : Dict[Tuple[str, str, tuple], int] = {} # (id, name, targets) -> index in buffer
+        self.lock = threading.Lock()
+        self.wakeup_pending = False
+        self.holds = 0
+
+        # Counters
+        self.enqueued = 0
+        self.coalesced = 0
+        self.wakeups = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def put(self, targets : list, message):
+        with self.lock:
+            self.enqueued += 1
+            if not (isinstance(message, dict) and self.coalesce(targets, message)):
+                self.buffer.append((targets, message, time.perf_counter()))
+            self.max_depth = max(self.max_depth, len(self.buffer))
+            if self.wakeup_pending or self.holds:
+                return
+            self.wakeup_pending = True
+        self.loop.call_soon_threadsafe(self.schedule_drain)
+
+    @contextmanager
+    def hold(self):
+        with self.lock:
+            self.holds += 1
+        try:
+            yield
+        finally:
+            # No return in here, so an exception raised in the with body propagates
+            with self.lock:
+                self.holds -= 1
+                wakeup = not (self.holds or self.wakeup_pending or not self.buffer)
+                if wakeup:
+                    self.wakeup_pending = True
+            if wakeup:
+                self.loop.call_soon_threadsafe(self.schedule_drain)
+
+    def coalesce(self, targets : list, message : dict):
+        '''
+        Returns True if the message replaced a buffered one. Must be called with the lock held.
+        '''
+        command = message.get('command')
+        if command == 'attribute':
+            key = (message['id'], message['name'], tuple(targets))
+            index = self.pending_attributes.get(key)
+            if index is not None:
+                self.buffer[index] = (targets, message, self.buffer[index][2])
+                self.coalesced += 1
+                return True
+            self.pending_attributes[key] = len(self.buffer)
+        elif command in ('create', 'destroy'):
+            self.pending_attributes.clear()
+        elif 'id' in message:
+            # Messages with a name (stream add, new attribute, ...) only affect that attribute
+            name = message.get('name')
+            for key in [key for key in self.pending_attributes if key[0] == message['id'] and name in (None, key[1])]:
+                del self.pending_attributes[key]
+        return False
+
+    def schedule_drain(self):
+        self.loop.call_later(self.flush_interval, self.drain)
+
+    def drain(self):
+        with self.lock:
+            if self.holds:
+                # The last hold to exit schedules the drain again
+                self.wakeup_pending = False
+                return
+            batch = self.buffer
+            self.buffer = []
+            self.pending_attributes.clear()
+            self.wakeup_pending = False
+            self.wakeups += 1
+        self.deliver(batch)
+
+    def record_latency(self, enqueue_time : float):
+        '''
+        Called by the sender when a message has been sent.
+        '''
+        latency = time.perf_counter() - enqueue_time
+        self.sent += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    @property
+    def depth(self):
+        return len(self.buffer)
+
+    def stats(self):
+        return {
+            'depth' : self.depth,
+            'max_depth' : self.max_depth,
+            'enqueued' : self.enqueued,
+            'coalesced' : self.coalesced,
+            'wakeups' : self.wakeups,
+            'sent' : self.sent,
+            'mean_latency' : self.total_latency / self.sent if self.sent else 0.0,
+            'max_latency' : self.max_latency,
+        }
@@ -0,0 +1,84 @@
+from __future__ import annotations
+from typing import Any, Dict, Optional
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from objectsync_server.object import Object
+import json
+import os
+import sys
+import tempfile
+import weakref
+import zlib
+
+class Payload:
+    '''
+    The serialization of an object's subtree kept by CommandCreate and CommandDestroy, so undo/redo can rebuild the subtree.
+
+    A payload never changes after it is made. A small one keeps the object's cached serialization, which shares the
+    dictionaries of unchanged descendants with the live objects' caches and with other payloads. A payload whose JSON is at
+    least compress_threshold bytes is kept as zlib-compressed JSON instead, and if spill_threshold is set, a compressed
+    payload of at least that many bytes is written to a file in spill_dir (the system's temporary directory if None).
+    The file is removed when the payload is freed.
+    '''
+    compress_threshold : Optional[int] = 64 << 10
+    compress_level = 1
+    spill_threshold : Optional[int] = None
+    spill_dir : Optional[str] = None
+
+    def __init__(self, obj : Object):
+        self.id = obj.id
+        self.d : Optional[Dict[str,Any]] = None
+        self.compressed : Optional[bytes] = None
+        self.path : Optional[str] = None
+        self.length = 0 # Bytes of the compressed payload
+
+        text = obj.serialize_json() if self.compress_threshold is not None else ''
+        if self.compress_threshold is None or len(text) < self.compress_threshold:
+            self.d = obj.serialize()
+            return
+
+        compressed = zlib.compress(text.encode('utf-8'), self.compress_level)
+        self.length = len(compressed)
+        if self.spill_threshold is not None and self.length >= self.spill_threshold:
+            fd, self.path = tempfile.mkstemp(prefix = 'objectsync-', suffix = '.payload', dir = self.spill_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            weakref.finalize(self, os.remove, self.path)
+        else:
+            self.compressed = compressed
+
+    def get(self) -> Dict[str,Any]:
+        '''
+        The serialization. Don't modify it.
+        '''
+        if self.d is not None:
+            return self.d
+        if self.compressed is not None:
+            compressed = self.compressed
+        else:
+            with open(self.path, 'rb') as f:
+                compressed = f.read()
+        return json.loads(zlib.decompress(compressed))
+
+    def estimate_size(self) -> int:
+        '''
+        Estimated bytes held in memory.
+        '''
+        if self.d is not None:
+            return estimate_value_size(self.d)
+        if self.compressed is not None:
+            return self.length
+        return 0
+
+def estimate_value_size(value) -> int:
+    '''
+    Estimated bytes of a JSON-like value, including the dictionaries and lists in it.
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + estimate_value_size(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += estimate_value_size(v)
+    return size
@@ -5,6 +5,9 @@ import asyncio
 import threading
 from .space import Space
 from .object import Object
+from .client import Client, ResyncPoint
+from .outbox import Outbox
+from .codec import MsgpackCodec, available_encodings, encode_json
 import json
 
 space_class : Optional[type] = None
@@ -20,14 +23,8 @@ import websockets_routes
 
 router = websockets_routes.Router()
 
-message_sender_started = False
-
 @router.route("/lobby") #* lobby
 async def lobby(websocket : websockets.legacy.server.WebSocketServerProtocol, path):
-    global message_sender_started
-    if not message_sender_started:
-        asyncio.create_task(message_sender_loop())
-        message_sender_started = True
     async for message in websocket:
         command=message[:3]
         message=message[4:]
@@ -40,59 +37,126 @@ async def lobby(websocket : websockets.legacy.server.WebSocketServerProtocol, pa
                 await websocket.send("msg space %s has started" % space_name)
             
             new_space : Space = space_class(name=space_name,obj_classes=obj_classes,root_obj_class = root_obj_class)
+            new_space.outbox = Outbox(asyncio.get_event_loop(), deliver_messages)
+            # Recover on the space thread, so replaying a long log doesn't stall the event loop. Being the first task,
+            # it runs before any client connection is handled.
+            new_space.post(new_space.recover)
             new_thread=threading.Thread(target=new_space.main_loop,name=space_name)
             new_thread.setDaemon(True)
             new_space.thread=new_thread
             spaces.update({space_name:new_space})
             new_thread.start()
-
-            new_space.send_message = lambda content, ws=None, exclude_ws = []: messages_to_client.put_nowait(([w for w in new_space.ws_clients if w != exclude_ws] if ws == None else [ws], content))
+            new_space.start_autosave()
 
             print(f'space {space_name} created')
 
+        elif command == "sts": # statistics of a space's outbox
+            space_name=message
+            if space_name in spaces and spaces[space_name].outbox is not None:
+                await websocket.send("msg %s" % json.dumps(spaces[space_name].outbox.stats()))
+            else:
+                await websocket.send("err no such space %s" % space_name)
+
+# Wire protocol versions a client can ask for in the url: /space/{space_name}/v{version}[+{encoding}]
+#   1 - one pretty-printed JSON message per frame (the default, used by older frontends)
+#   2 - each frame is an array of all messages queued within one batch tick, in compact JSON (default) or msgpack
+#   3 - like 2, but the snapshot is sent in "load chunk" messages followed by "load complete" instead of one "load"
+PROTOCOL_VERSIONS = (1, 2, 3)
+clients : Dict[websockets.legacy.server.WebSocketServerProtocol, Client] = {}
+
+# The msgpack codec of each space, shared by all msgpack clients of the space
+codecs : Dict[str, MsgpackCodec] = {}
+
 # The main loop that handle an ws client connected to an space
 @router.route("/space/{space_name}")
 async def space_ws(websocket : websockets.legacy.server.WebSocketServerProtocol, path):
     '''
-    Connect the client to the space
+    Connect the client to the space, using the legacy protocol
     '''
-    space_name=path.params["space_name"]
+    await space_session(websocket, path.params["space_name"], 1)
+
+@router.route("/space/{space_name}/{protocol}")
+async def space_ws_versioned(websocket : websockets.legacy.server.WebSocketServerProtocol, path):
+    '''
+    Connect the client to the space, using the protocol version and encoding given in the url (e.g. "v2", "v3+msgpack")
+    '''
+    protocol = path.params["protocol"]
+    version, _, encoding = protocol.partition('+')
+    version = int(version[1:]) if version[:1] == 'v' and version[1:].isdigit() else None
+    encoding = encoding or 'json'
+    if version not in PROTOCOL_VERSIONS or encoding not in available_encodings() or (encoding != 'json' and version < 2):
+        await websocket.send("err unsupported protocol %s" % protocol)
+        await websocket.close()
+        return
+    await space_session(websocket, path.params["space_name"], version, encoding)
+
+async def space_session(websocket : websockets.legacy.server.WebSocketServerProtocol, space_name : str, version : int, encoding : str = 'json'):
     if space_name in spaces:
         space=spaces[space_name]
         await websocket.send("msg connected to space %s" % space_name)
     else:
         await websocket.send("err no such space %s" % space_name)
-        websocket.close()
+        await websocket.close()
         return
 
-    space.OnClientConnection(websocket)
-    print(f"Client connected to {space_name}")
+    codec = None
+    if encoding == 'msgpack':
+        if space_name not in codecs:
+            codecs[space_name] = MsgpackCodec()
+        codec = codecs[space_name]
+    clients[websocket] = Client(websocket, space, version, codec)
+    space.post(lambda: space.OnClientConnection(websocket, chunked = version >= 3))
+    print(f"Client connected to {space_name} (protocol v{version}+{encoding})")
 
     '''
     Session loop
     '''
     try:
-        lock = asyncio.Lock()
         async for message in websocket:
-            async with lock:
-                space.recieve_message(message,websocket)
+            # Some messages can't wait for the space thread, like cancelling the work that keeps it busy
+            if space.interrupt(message,websocket):
+                continue
+            # The space thread processes the message. Frames received before it gets to them are coalesced and processed together.
+            space.post_message(message,websocket)
 
     except websockets.exceptions.ConnectionClosed:
         print(f"Client disconnected from {space_name}")
+    finally:
+        clients.pop(websocket).close()
+        space.post(lambda: space.OnClientDisconnection(websocket))
 
-messages_to_client: Optional[asyncio.Queue[Tuple[list[websockets.legacy.server.WebSocketServerProtocol],Dict]]] = None
-async def message_sender_loop():
+def deliver_messages(batch : List[Tuple[list, Dict, float]]):
     '''
-    The async loop that reads messages_to_client then sends messages to clients
+    Called on the event loop with a batch of messages from a space's outbox. Hands the messages to the clients' own queues.
+    Each message is encoded at most once per wire format and the encoded message is shared by all its recipients.
     '''
-    global messages_to_client
-    messages_to_client = asyncio.Queue() 
-    while True:
-        ws_list,message = await messages_to_client.get()
+    for ws_list, message, enqueue_time in batch:
+        if isinstance(message, ResyncPoint):
+            for ws in ws_list:
+                if ws in clients:
+                    clients[ws].end_resync()
+            continue
+        encoded = {}
         for ws in ws_list:
-            if not ws.open:
+            client = clients.get(ws)
+            if client is None:
                 continue
-            await ws.send(json.dumps(message, indent=4))
+            wire_format = client.wire_format
+            if wire_format not in encoded:
+                encoded[wire_format] = encode_message(message, client, enqueue_time)
+            client.put(encoded[wire_format], enqueue_time)
+
+def encode_message(message, client : Client, enqueue_time : float):
+    if client.encoding == 'msgpack':
+        packed, new_names = client.codec.encode(message)
+        if new_names:
+            # Every msgpack client of the space shares the intern table, so they all need the new names
+            names = client.codec.encode_names(new_names)
+            for other in clients.values():
+                if other.codec is client.codec:
+                    other.put(names, enqueue_time)
+        return packed
+    return encode_json(message, compact = client.version >= 2)
 
 def start(space_class_:Type[Space], obj_classes_ : Dict[str,Type[Object]], root_obj_class_ : Type[Object],host = 'localhost', port = 1000):
     """
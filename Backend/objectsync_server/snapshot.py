@@ -0,0 +1,111 @@
+from __future__ import annotations
+from typing import Dict, Iterator, List, Tuple
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from objectsync_server.object import Object
+import json
+import mmap
+import os
+import struct
+
+# Snapshot file layout (all integers little-endian):
+#
+#   header  : MAGIC, uint16 format version
+#   records : one per object, in pre-order (a parent is always before its children, and siblings keep their order)
+#             uint32 length, then the compact JSON of the object's serialization without children
+#   index   : uint32 length, then the compact JSON of {object id : offset of its record}
+#   footer  : uint64 offset of the index, MAGIC
+#
+# The records can be read one by one while loading, and the index lets a memory-mapped reader fetch a single object lazily.
+
+MAGIC = b'OSSN'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sH')
+LENGTH = struct.Struct('<I')
+FOOTER = struct.Struct('<Q4s')
+
+def collect_records(root : Object) -> List[Tuple[str,str]]:
+    '''
+    Returns (id, JSON) of the objects in root's subtree in pre-order. Must be called on the space thread.
+    The JSON strings are the objects' cached shallow serializations, so this is cheap when the objects haven't changed.
+    '''
+    space = root.space
+    records = []
+    pending = [root.id]
+    while pending:
+        obj = space[pending.pop()]
+        records.append((obj.id, obj.serialize_shallow_json()))
+        pending.extend(reversed(obj.children_ids))
+    return records
+
+def write_snapshot(path : str, records : List[Tuple[str,str]]):
+    '''
+    Write records from collect_records() to a snapshot file. Can be called from any thread.
+    The file is written next to path and then renamed, so path always holds a complete snapshot.
+    '''
+    temp_path = path + '.tmp'
+    index : Dict[str,int] = {}
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+        for id, text in records:
+            index[id] = f.tell()
+            data = text.encode('utf-8')
+            f.write(LENGTH.pack(len(data)))
+            f.write(data)
+        index_offset = f.tell()
+        data = json.dumps(index, separators=(',',':')).encode('utf-8')
+        f.write(LENGTH.pack(len(data)))
+        f.write(data)
+        f.write(FOOTER.pack(index_offset, MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+class SnapshotReader:
+    '''
+    Memory-maps a snapshot file. Iterate it to get the serializations (without children) in pre-order,
+    or use reader[id] to read one object through the index.
+    '''
+    def __init__(self, path : str):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, version = HEADER.unpack_from(self.map, 0)
+        index_offset, end_magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != MAGIC or end_magic != MAGIC:
+            raise ValueError(f'{path} is not a snapshot file')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported snapshot format version {version}')
+        self.index_offset = index_offset
+        self._index = None
+
+    @property
+    def index(self) -> Dict[str,int]:
+        if self._index is None:
+            self._index = json.loads(self.read_record(self.index_offset))
+        return self._index
+
+    def read_record(self, offset : int) -> bytes:
+        (length,) = LENGTH.unpack_from(self.map, offset)
+        start = offset + LENGTH.size
+        return self.map[start:start + length]
+
+    def __getitem__(self, id : str) -> dict:
+        return json.loads(self.read_record(self.index[id]))
+
+    def __iter__(self) -> Iterator[dict]:
+        offset = HEADER.size
+        while offset < self.index_offset:
+            data = self.read_record(offset)
+            yield json.loads(data)
+            offset += LENGTH.size + len(data)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -1,27 +1,87 @@
 from __future__ import annotations
-from typing import Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from .object import Object
-from objectsync_server.command import CommandManager, CommandCreate, CommandDestroy
+from .outbox import Outbox
+from .ancestry import AncestryIndex
+from .indexes import ObjectIndexes
+from .codec import JSONText
+from .snapshot import collect_records, write_snapshot, SnapshotReader
+from . import wal
+from objectsync_server.object import Attribute
+from objectsync_server.command import Command, CommandManager, CommandCreate, CommandDestroy, History, HistoryItem
 
 import json
+import os
+import queue
+import threading
+import traceback
+from collections import OrderedDict, deque
+from contextlib import nullcontext
 from itertools import count
 
 class Space():
     '''
     In ObjectSync, `Object`s must be created in a `Space`. A `Space` has a collection of `Object`s. It assigns an unique id to each `Object` created in it, so `Object`s in the same `Space` can access each other with the ids.
+
+    A space runs main_loop() on its own thread, and that thread is the only one that changes the space's objects.
+    Other threads (like the server's event loop) hand work to it with post().
     '''
     obj_classes = {}
+    snapshot_chunk_size = 200
+
+    # Where save() and load() keep snapshot files, and how often (in seconds) the space saves itself if it has changed. None disables autosave.
+    save_dir = 'saves'
+    autosave_interval : Optional[float] = None
+
+    # Whether to keep an operation log (see wal.py) in save_dir, which recover() uses to rebuild the space after a restart.
+    # The log is folded into a new checkpoint when it grows over compact_threshold bytes (checked every compact_check_interval seconds).
+    write_ahead_log = True
+    compact_threshold = 16 << 20
+    compact_check_interval = 10.0
+
+    # Bounds of all histories in the space together, in items and in estimated bytes. None for no bound.
+    # A command is counted once for each history it is in.
+    history_max_entries : Optional[int] = 100000
+    history_max_bytes : Optional[int] = 256 << 20
+
+    # Attributes to index for find(), in addition to the indexed_attributes of the object classes
+    indexed_attributes : Tuple[str,...] = ()
+
     def __init__(self,name, obj_classes:Dict[str,type], root_obj_class:type = Object):
         self.name = name
         self.thread=None
         self.id_iter = count(1)
         self.ws_clients = []
+        self.outbox : Optional[Outbox] = None # Set by server.py
+
+        # Messages from clients waiting to be processed
+        self.inbox : deque[Tuple[str,object]] = deque()
+        self.inbox_lock = threading.Lock()
+        self.inbox_scheduled = False
+
+        # Tasks to run on the space thread. Subclasses with their own main_loop() may override post() instead.
+        self.tasks : queue.SimpleQueue[Callable[[],None]] = queue.SimpleQueue()
         self.command_manager = CommandManager(self)
+        self.ancestry = AncestryIndex()
+
+        # Items of all histories, oldest first
+        self.history_items : OrderedDict[HistoryItem,None] = OrderedDict()
+        self.history_bytes = 0
+        self.command_refs : Dict[Command,int] = {} # Commands in histories -> the number of histories they are in
 
         self.obj_classes = obj_classes
+        self.indexes = ObjectIndexes(set(self.indexed_attributes).union(
+            *(c.indexed_attributes for c in list(obj_classes.values()) + [root_obj_class])))
+
+        # Incremented whenever an object changes. Autosave compares it with the revision of the last save.
+        self.revision = 0
+        self.saved_revision = -1
+        self.save_lock = threading.Lock()
+        self.operation_log : Optional[wal.OperationLog] = None
         
         self.objs = {}   
         self.root_obj : Object = root_obj_class(self,{'id':'0'},is_new = True)
+        self.indexes.add(self.root_obj)
         self.send_message({'command':'create','d':self.root_obj.serialize()})  
 
         self.flush = True
@@ -29,13 +89,72 @@ class Space():
     def __getitem__(self,key):
         return self.objs[key]
 
+    def post(self,task:Callable[[],None]):
+        '''
+        Run task on the space thread. Can be called from any thread.
+        '''
+        self.tasks.put(task)
+
+    def post_message(self,message,ws):
+        '''
+        Queue a message from a client to be processed on the space thread. Can be called from any thread.
+        '''
+        with self.inbox_lock:
+            self.inbox.append((message,ws))
+            if self.inbox_scheduled:
+                return
+            self.inbox_scheduled = True
+        self.post(self.process_inbox)
+
+    def interrupt(self,message,ws) -> bool:
+        '''
+        Called on the event loop thread with every message from a client, before the message is queued for the space thread.
+        Returns True if the message is handled here. Subclasses handle messages that can't wait, like cancelling the running work.
+        '''
+        return False
+
+    def process_inbox(self):
+        '''
+        Process all queued messages from clients.
+        '''
+        with self.inbox_lock:
+            messages = list(self.inbox)
+            self.inbox.clear()
+            self.inbox_scheduled = False
+
+        parsed = []
+        for message, ws in messages:
+            try:
+                parsed.append((json.loads(message),ws)) # message is in Json
+            except json.JSONDecodeError:
+                traceback.print_exc()
+
+        for m, ws in coalesce_attribute_messages(parsed):
+            try:
+                self.handle_message(m,ws)
+            except Exception:
+                traceback.print_exc()
+
     def recieve_message(self,message,ws):
+        self.handle_message(json.loads(message),ws) # message is in Json
 
-        m=json.loads(message) # message is in Json
+    def handle_message(self,m,ws):
         
         print('-- client:\t',m)
         command=m['command']
 
+        try:
+            self.handle_command(m,ws)
+        finally:
+            temp = len(self.command_manager.collected_commands)
+            if self.flush:
+                self.command_manager.flush()
+
+        if temp>0 and self.flush or command == 'undo' or command == 'redo':
+            print(self.root_obj.history)
+
+    def handle_command(self,m,ws):
+        command=m['command']
 
         # Create an Object in the space
         if command == "create":
@@ -49,46 +168,104 @@ class Space():
             CommandDestroy(self,m['id']).execute()
             self.send_message("msg  %s destroyed" % (m['id']),ws)
 
+        # Copy objects with their subtrees
+        elif command == "clone":
+            id_map = self.clone_subtree(m['ids'],m['parent'])
+            self.send_message(f"msg cloned {json.dumps(id_map)}",ws)
+
+        # Apply many commands at once. They are flushed to history as one CommandSequence and their messages are sent together.
+        elif command == "batch":
+            with self.hold_messages():
+                for sub_m in m['commands']:
+                    self.handle_command(sub_m,ws)
+
         elif command == "flush on":
             self.flush = True
         elif command == "flush off":
             self.flush = False
 
-        #TODO
+        # Report how much memory the histories use
+        elif command == "history stats":
+            stats = self.history_stats()
+            if 'id' in m:
+                stats['object'] = self[m['id']].history.stats()
+            self.send_message(f"msg history {json.dumps(stats)}",ws)
+
         # Save the graph to disk
         elif command == "save":
-            pass
+            path = self.save(m.get('name'))
+            self.send_message(f"msg saved to {path}",ws)
 
         # Load the graph from disk
         elif command == "load":
-            pass
+            path = self.load(m.get('name'))
+            self.send_message(f"msg loaded from {path}",ws)
         
         # Let the object handle other messages
         else:
             self.objs[m['id']].recieve_message(m,ws)
 
-        temp = len(self.command_manager.collected_commands)
-        if self.flush:
-            self.command_manager.flush()
-
-        if temp>0 and self.flush or command == 'undo' or command == 'redo':
-            print(self.root_obj.history)
+    def hold_messages(self):
+        '''
+        Returns a context manager. Messages sent inside it are delivered together when it exits.
+        '''
+        if self.outbox is None:
+            return nullcontext()
+        return self.outbox.hold()
 
-    def send_message(_, message,ws = None, exclude_ws = None):
+    def send_message(self, message,ws = None, exclude_ws = None):
         '''
-        This will be overwritten by server.py
+        Send a message to a client (ws), or to all clients except exclude_ws. Can be called from any thread.
         '''
+        if self.outbox is None:
+            return
+        if ws is None:
+            targets = [w for w in self.ws_clients if w != exclude_ws]
+        else:
+            targets = [ws]
+        self.outbox.put(targets, message)
 
-    def OnClientConnection(self,ws):
+    def OnClientConnection(self,ws,chunked = False):
         self.ws_clients.append(ws)
+        self.send_snapshot(ws,chunked)
+
+    def OnClientDisconnection(self,ws):
+        if ws in self.ws_clients:
+            self.ws_clients.remove(ws)
+
+    def send_snapshot(self,ws,chunked = False):
+        '''
+        Send the whole space to a client. Also used to resync a client that falls behind.
+
+        If chunked, the objects are sent breadth-first in "load chunk" messages of snapshot_chunk_size objects each
+        (without their children, so a parent always arrives before its children), followed by "load complete".
+        The chunks are queued before any later change, so updates always arrive after the objects they refer to.
+        '''
         self.send_message({
             'command':'space_metadata',
             'types':list(self.obj_classes.keys()),
             },ws)
-        self.send_message({
-            'command':'load',
-            'root_object':self.root_obj.serialize(),
-            },ws)
+
+        if not chunked:
+            self.send_message({
+                'command':'load',
+                'root_object':self.root_obj.serialize_encoded(),
+                },ws)
+            return
+
+        pending = deque([self.root_obj.id])
+        chunk = []
+        while pending:
+            obj = self[pending.popleft()]
+            chunk.append(obj)
+            pending.extend(obj.children_ids)
+            if len(chunk) == self.snapshot_chunk_size or not pending:
+                self.send_message({
+                    'command':'load chunk',
+                    'objects':JSONText([o.serialize_shallow() for o in chunk], '[' + ','.join(o.serialize_shallow_json() for o in chunk) + ']'),
+                    },ws)
+                chunk = []
+        self.send_message({'command':'load complete'},ws)
 
     def GetMetadata(self):
         pass
@@ -114,24 +291,347 @@ class Space():
         else:
             new_instance = c(self,d,is_new)
             parent = d['attributes']['parent_id']['value']
+        self.indexes.add(new_instance)
 
         self.objs[parent].OnChildCreated(new_instance)
 
         if send:
-            self.send_message({'command':'create','d':new_instance.serialize()})
+            self.send_message({'command':'create','d':new_instance.serialize_encoded()})
 
         return new_instance
 
+    def clone_subtree(self,src_ids,new_parent) -> Dict[str,str]:
+        '''
+        Copy objects with their subtrees under new_parent. Returns the map from the original ids to the copies' ids.
+
+        An object in src_ids that is inside the subtree of another one is copied once, with that subtree. References between
+        the copied objects are changed to the copies (see Object.remap_ids()). The copies are created in one pass and sent
+        with one "create" message per copied subtree, and the CommandCreates are flushed to history as one step.
+        '''
+        selected = set(src_ids)
+        roots = []
+        for id in dict.fromkeys(src_ids):
+            ancestor = self.ancestry.parent(id)
+            while ancestor is not None and ancestor not in selected:
+                ancestor = self.ancestry.parent(ancestor)
+            if ancestor is None:
+                assert id != self.root_obj.id, 'The root object can\'t be cloned'
+                roots.append(id)
+
+        id_map : Dict[str,str] = {}
+        for root in roots:
+            pending = [root]
+            while pending:
+                id = pending.pop()
+                id_map[id] = str(next(self.id_iter))
+                pending.extend(self[id].children_ids)
+
+        def remap(d):
+            new_d = self.obj_classes[d['type']].remap_ids(d,id_map)
+            new_d['children'] = [remap(child_d) for child_d in d.get('children',[])]
+            return new_d
+
+        # Copy everything before creating anything, as new_parent may be inside a copied subtree
+        copies = [remap(self[root].serialize()) for root in roots]
+        with self.hold_messages():
+            for d in copies:
+                d['attributes']['parent_id'] = dict(d['attributes']['parent_id'], value = new_parent)
+                CommandCreate(self,d,new_parent,is_new = False).execute()
+        return id_map
+
     def destroy(self,id):
+        '''
+        Destroy an object and all its descendants in one pass. OnDestroy() is called on descendants before their ancestors.
+        Clients get one "destroy" message for the whole subtree.
+        '''
         self.send_message({'command':'destroy','id':id})
-        parent_id = self.objs[id].parent_id.value
-        self.objs[parent_id].OnChildDestroyed(self[id])
-        self.objs[id].OnDestroy()
-        self.objs.pop(id)
-    
-    def main_loop(self):
-        raise NotImplementedError()
+        obj = self.objs[id]
+        self.objs[obj.parent_id.value].OnChildDestroyed(obj)
 
+        subtree = [] # Pre-order, so reversed it has every object before its ancestors
+        pending = [id]
+        while pending:
+            subtree.append(pending.pop())
+            pending.extend(self.objs[subtree[-1]].children_ids)
+        for id in reversed(subtree):
+            obj = self.objs.pop(id)
+            self.command_manager.on_destroy(id,obj.parent_id.value)
+            obj.OnDestroy()
+            obj.history.clear()
+            self.ancestry.remove(id)
+            self.indexes.remove(obj)
 
+    def find(self,cls : Optional[type] = None,frontend_type : Optional[str] = None,attributes : Optional[Dict[str,Any]] = None) -> List[Object]:
+        '''
+        The objects that are instances of cls (or its subclasses), have the frontend_type, and whose attributes have the given
+        values, in no particular order. Omitted conditions match everything.
+        The lookups use the indexes. Attributes that aren't indexed (see indexed_attributes) are checked on the remaining objects.
+        '''
+        attributes = attributes or {}
+        result = [self.objs[id] for id in self.indexes.find(cls,frontend_type,attributes)]
+        unindexed = {name : value for name, value in attributes.items() if name not in self.indexes.by_attribute}
+        if unindexed:
+            result = [obj for obj in result if all(name in obj.attributes and obj.attributes[name].value == value for name, value in unindexed.items())]
+        return result
 
-    
\ No newline at end of file
+    def add_attribute_index(self,name : str):
+        '''
+        Start indexing an attribute for find().
+        '''
+        self.indexes.add_attribute_index(name,self.objs.values())
+
+    def on_history_push(self,item:HistoryItem):
+        self.history_items[item] = None
+        self.history_bytes += item.size
+        self.command_refs[item.command] = self.command_refs.get(item.command,0) + 1
+
+    def on_history_forget(self,item:HistoryItem):
+        del self.history_items[item]
+        self.history_bytes -= item.size
+        self.release_command(item.command)
+
+    def release_command(self,command:Command):
+        self.command_refs[command] -= 1
+        if self.command_refs[command] == 0:
+            del self.command_refs[command]
+
+    def trim_history(self):
+        '''
+        Compact or evict the oldest history items until all histories together are within the space's bounds.
+        '''
+        while self.history_items and (
+                (self.history_max_entries is not None and len(self.history_items) > self.history_max_entries) or
+                (self.history_max_bytes is not None and self.history_bytes > self.history_max_bytes)):
+            oldest = next(iter(self.history_items))
+            oldest.history.evict_oldest()
+
+    def history_stats(self):
+        return {
+            'entries' : len(self.history_items),
+            'bytes' : self.history_bytes,
+            'max_entries' : self.history_max_entries,
+            'max_bytes' : self.history_max_bytes,
+            }
+
+    def snapshot_path(self,name = None):
+        name = os.path.basename(name or self.name)
+        return os.path.join(self.save_dir, name + '.snapshot')
+
+    def save(self,name = None,background = False):
+        '''
+        Save all objects to a snapshot file. Must be called on the space thread.
+        If background, the file is written on another thread, and only the collection of the objects' (cached) serializations blocks the space.
+        '''
+        path = self.snapshot_path(name)
+        os.makedirs(self.save_dir, exist_ok = True)
+        records = collect_records(self.root_obj)
+        self.saved_revision = self.revision
+
+        def write():
+            with self.save_lock:
+                write_snapshot(path, records)
+
+        if background:
+            threading.Thread(target = write, name = f'{self.name} save', daemon = True).start()
+        else:
+            write()
+        return path
+
+    def load(self,name = None):
+        '''
+        Replace all objects with the ones in a snapshot file. Must be called on the space thread.
+        '''
+        path = self.snapshot_path(name)
+        self.load_file(path)
+        if self.operation_log is not None:
+            # The log can't replay a load, so fold it into a checkpoint right away
+            self.checkpoint()
+        return path
+
+    def load_file(self,path,send = True):
+        '''
+        Replace all objects with the ones in a snapshot file. History is cleared because its commands refer to the replaced objects.
+        '''
+        with SnapshotReader(path) as reader:
+            records = iter(reader)
+            root_d = next(records)
+
+            # Destroy the current objects
+            for id in list(self.root_obj.children_ids):
+                self.destroy(id)
+
+            for attr_name, attr_dict in root_d['attributes'].items():
+                if attr_name == 'parent_id':
+                    continue
+                if attr_name in self.root_obj.attributes:
+                    self.root_obj.attributes[attr_name].set(attr_dict['value'])
+                else:
+                    Attribute(self.root_obj,attr_name,attr_dict['type'],attr_dict['value'],attr_dict.get('history_object','none'))
+                    self.send_message({'command':'new attribute','id':self.root_obj.id,'name':attr_name,'type':attr_dict['type'],
+                        'value':attr_dict['value'],'history_object':attr_dict.get('history_object','none')})
+
+            # Records are in pre-order, so every parent exists before its children are created
+            for d in records:
+                self.create(d,is_new = False,send = False)
+
+        self.update_id_iter()
+        self.command_manager.collected_commands = []
+        self.command_manager.unlogged = []
+        self.root_obj.history.clear()
+        if send:
+            for child_id in self.root_obj.children_ids:
+                self.send_message({'command':'create','d':self[child_id].serialize_encoded()})
+        self.saved_revision = self.revision
+
+    def update_id_iter(self):
+        '''
+        Continue the ids after the largest id in the space.
+        '''
+        max_id = max([int(id) for id in self.objs if id.isdigit()], default = 0)
+        self.id_iter = count(max_id + 1)
+
+    def log_command(self,command,undo = False):
+        '''
+        Append the changes of a command that is executed, undone or redone to the operation log.
+        '''
+        if self.operation_log is not None:
+            self.command_manager.log(command.log_records(undo))
+
+    def log_record(self,record):
+        '''
+        Append a change that isn't made by a command to the operation log.
+        '''
+        if self.operation_log is not None:
+            self.command_manager.log([record])
+
+    def write_log(self,records):
+        if self.operation_log is None:
+            return
+        for record in records:
+            self.operation_log.append(record)
+
+    def apply_log_record(self,record):
+        op = record['op']
+        if op == 'create':
+            if record['d']['id'] not in self.objs:
+                self.create(record['d'],is_new = False,send = False)
+        elif op == 'destroy':
+            if record['id'] in self.objs:
+                self.destroy(record['id'])
+        elif op == 'attribute':
+            if record['id'] in self.objs and record['name'] in self[record['id']].attributes:
+                self[record['id']].attributes[record['name']].set(record['value'],send = False)
+        elif op == 'new attribute':
+            if record['id'] in self.objs and record['name'] not in self[record['id']].attributes:
+                Attribute(self[record['id']],record['name'],record['type'],record['value'],record['history_object'])
+        elif op == 'delete attribute':
+            obj = self.objs.get(record['id'])
+            if obj is not None and record['name'] in obj.attributes:
+                obj.attributes.pop(record['name'])
+                self.indexes.remove_attribute(obj.id,record['name'])
+                obj.invalidate_serialization()
+
+    def recover(self):
+        '''
+        Rebuild the space from its newest checkpoint and the operation logs after it, then start a new checkpoint and log.
+        Call this before the space handles anything else, like as the first task posted to the space thread.
+        Does nothing if write_ahead_log is False.
+        '''
+        if not self.write_ahead_log:
+            return
+        checkpoints = wal.generations(self.save_dir, self.name, 'checkpoint')
+        logs = wal.generations(self.save_dir, self.name, 'log')
+        if checkpoints:
+            generation = checkpoints[-1]
+            self.load_file(wal.checkpoint_path(self.save_dir, self.name, generation),send = False)
+            for log_generation in logs:
+                if log_generation >= generation:
+                    for record in wal.read_log(wal.log_path(self.save_dir, self.name, log_generation)):
+                        self.apply_log_record(record)
+            self.update_id_iter()
+            print(f'space {self.name} recovered from checkpoint {generation} and {len([g for g in logs if g >= generation])} logs')
+
+        last = max(checkpoints + logs, default = -1)
+        self.operation_log = wal.OperationLog(self.save_dir, self.name, last + 1)
+        self.checkpoint(background = False)
+        self.start_compactor()
+
+    def checkpoint(self,background = True):
+        '''
+        Fold the operation log into a new checkpoint. Must be called on the space thread.
+        Only collecting the objects' (cached) serializations blocks the space; the file is written in the background.
+        '''
+        records = collect_records(self.root_obj)
+        generation = self.operation_log.rotate()
+        path = wal.checkpoint_path(self.save_dir, self.name, generation)
+
+        def write():
+            with self.save_lock:
+                write_snapshot(path, records)
+                self.operation_log.remove_before(generation)
+
+        if background:
+            threading.Thread(target = write, name = f'{self.name} checkpoint', daemon = True).start()
+        else:
+            write()
+
+    def start_compactor(self):
+        def check():
+            if self.operation_log.size() > self.compact_threshold:
+                self.post(self.checkpoint)
+            timer = threading.Timer(self.compact_check_interval, check)
+            timer.daemon = True
+            timer.start()
+
+        timer = threading.Timer(self.compact_check_interval, check)
+        timer.daemon = True
+        timer.start()
+
+    def start_autosave(self):
+        '''
+        Start saving the space every autosave_interval seconds if it has changed. The file is written in the background.
+        '''
+        if self.autosave_interval is None:
+            return
+
+        def autosave():
+            if self.revision != self.saved_revision:
+                self.save(background = True)
+
+        def tick():
+            self.post(autosave)
+            timer = threading.Timer(self.autosave_interval, tick)
+            timer.daemon = True
+            timer.start()
+
+        timer = threading.Timer(self.autosave_interval, tick)
+        timer.daemon = True
+        timer.start()
+
+    def main_loop(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                task()
+            except Exception:
+                # One failing task (like an autosave that can't write) must not stop the space
+                traceback.print_exc()
+
+def coalesce_attribute_messages(messages : List[Tuple[dict,object]]) -> List[Tuple[dict,object]]:
+    '''
+    Drop "attribute" messages that are replaced by a newer value of the same attribute later in the list.
+    Only runs of "attribute" messages are coalesced; any other message keeps the order around it.
+    '''
+    result = []
+    newer = set() # (id, name) of attributes that have a newer value after the current position
+    for m, ws in reversed(messages):
+        if m.get('command') == 'attribute':
+            key = (m.get('id'),m.get('name'))
+            if key in newer:
+                continue
+            newer.add(key)
+        else:
+            newer.clear()
+        result.append((m,ws))
+    result.reverse()
+    return result
@@ -0,0 +1,134 @@
+from __future__ import annotations
+from typing import Iterator, List
+import json
+import os
+import re
+import struct
+import threading
+import time
+
+# An operation log is a sequence of records, each a uint32 length (little-endian) followed by the compact JSON of the record:
+#   {"op": "create", "d": <serialization>}
+#   {"op": "destroy", "id": <id>}
+#   {"op": "attribute", "id": <id>, "name": <name>, "value": <value>}
+#   {"op": "new attribute", "id": <id>, "name": <name>, "type": <type>, "value": <value>, "history_object": <history object>}
+#   {"op": "delete attribute", "id": <id>, "name": <name>}
+#
+# The log of a space is split into generations: <name>.<generation>.log. A checkpoint, <name>.<generation>.checkpoint, is a
+# snapshot file (see snapshot.py) of the space right before the log of that generation started. Recovery loads the newest
+# checkpoint and replays the logs from its generation on.
+
+LENGTH = struct.Struct('<I')
+
+class OperationLog:
+    '''
+    Appends records to the current generation's log file.
+
+    append() only buffers the record. A writer thread commits the buffer in groups: it waits commit_interval seconds after the
+    first record so more records can join, then writes them all and fsyncs once.
+    '''
+    commit_interval = 0.05
+
+    def __init__(self, directory : str, name : str, generation : int):
+        self.directory = directory
+        self.name = name
+        self.generation = generation
+        self.lock = threading.Condition()
+        self.buffer : List[bytes] = []
+        os.makedirs(directory, exist_ok = True)
+        self.file = open(log_path(directory, name, generation), 'ab')
+
+        self.writer = threading.Thread(target = self.writer_loop, name = f'{name} log writer', daemon = True)
+        self.writer.start()
+
+    def append(self, record : dict):
+        data = json.dumps(record, separators=(',',':'), default=lambda o: o.value).encode('utf-8')
+        with self.lock:
+            self.buffer.append(LENGTH.pack(len(data)) + data)
+            self.lock.notify()
+
+    def writer_loop(self):
+        while True:
+            with self.lock:
+                while not self.buffer:
+                    self.lock.wait()
+            time.sleep(self.commit_interval)
+            with self.lock:
+                self.commit()
+
+    def commit(self):
+        '''
+        Write and fsync the buffered records. Must be called with the lock held.
+        '''
+        if not self.buffer:
+            return
+        self.file.write(b''.join(self.buffer))
+        self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def rotate(self) -> int:
+        '''
+        Commit the current log and start the next generation. Returns the new generation.
+        '''
+        with self.lock:
+            self.commit()
+            self.file.close()
+            self.generation += 1
+            self.file = open(log_path(self.directory, self.name, self.generation), 'ab')
+            return self.generation
+
+    def size(self) -> int:
+        with self.lock:
+            return self.file.tell()
+
+    def remove_before(self, generation : int):
+        '''
+        Delete the logs and checkpoints of generations before generation.
+        '''
+        for kind in ('log', 'checkpoint'):
+            for old in generations(self.directory, self.name, kind):
+                if old < generation:
+                    os.remove(file_path(self.directory, self.name, old, kind))
+
+def file_path(directory : str, name : str, generation : int, kind : str) -> str:
+    return os.path.join(directory, f'{name}.{generation}.{kind}')
+
+def log_path(directory : str, name : str, generation : int) -> str:
+    return file_path(directory, name, generation, 'log')
+
+def checkpoint_path(directory : str, name : str, generation : int) -> str:
+    return file_path(directory, name, generation, 'checkpoint')
+
+def generations(directory : str, name : str, kind : str) -> List[int]:
+    '''
+    The generations of the existing logs or checkpoints (kind = 'log' or 'checkpoint') of a space, in ascending order.
+    '''
+    if not os.path.isdir(directory):
+        return []
+    pattern = re.compile(re.escape(name) + r'\.(\d+)\.' + kind + '$')
+    found = []
+    for file_name in os.listdir(directory):
+        match = pattern.match(file_name)
+        if match:
+            found.append(int(match.group(1)))
+    return sorted(found)
+
+def read_log(path : str) -> Iterator[dict]:
+    '''
+    Read the records of a log file. Stops at a torn record at the end of the file (from a crash in the middle of a write).
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + LENGTH.size <= len(data):
+        (length,) = LENGTH.unpack_from(data, offset)
+        start = offset + LENGTH.size
+        if start + length > len(data):
+            break
+        try:
+            record = json.loads(data[start:start + length])
+        except ValueError:
+            break
+        yield record
+        offset = start + length
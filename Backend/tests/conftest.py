@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the server are imported from the Backend directory, like main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
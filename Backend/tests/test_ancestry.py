@@ -0,0 +1,68 @@
+import random
+from objectsync_server.ancestry import AncestryIndex
+
+class Tree:
+    '''
+    A naive parent map to check the index against.
+    '''
+    def __init__(self):
+        self.parents = {'0' : None}
+        self.index = AncestryIndex()
+        self.index.add('0', None)
+
+    def add(self, id, parent):
+        self.parents[id] = parent
+        self.index.add(id, parent)
+
+    def children(self, id):
+        return [child for child, parent in self.parents.items() if parent == id]
+
+    def move(self, id, parent):
+        self.parents[id] = parent
+        self.index.move(id, parent, self.children)
+
+    def ancestors(self, id):
+        chain = []
+        while id is not None:
+            chain.append(id)
+            id = self.parents[id]
+        return chain
+
+    def lca(self, a, b):
+        ancestors = set(self.ancestors(a))
+        return next(id for id in self.ancestors(b) if id in ancestors)
+
+def test_lca_of_a_chain_and_siblings():
+    tree = Tree()
+    for i, parent in enumerate(['0', '1', '2', '3', '1', '5']):
+        tree.add(str(i + 1), parent)
+    assert tree.index.lca('4', '6') == '1'
+    assert tree.index.lca('4', '2') == '2'
+    assert tree.index.lca('4', '4') == '4'
+    assert tree.index.lca('0', '6') == '0'
+    assert tree.index.parent('4') == '3'
+    assert tree.index.parent('0') is None
+
+def test_lca_after_moves():
+    rng = random.Random(0)
+    tree = Tree()
+    for i in range(1, 300):
+        # Mostly deep chains, so the jump tables have several levels
+        parent = str(i - 1) if rng.random() < 0.7 else rng.choice(list(tree.parents))
+        tree.add(str(i), parent)
+    for _ in range(100):
+        id = rng.choice(list(tree.parents)[1:])
+        parent = rng.choice([other for other in tree.parents if id not in tree.ancestors(other)])
+        tree.move(id, parent)
+    ids = list(tree.parents)
+    for _ in range(2000):
+        a, b = rng.choice(ids), rng.choice(ids)
+        assert tree.index.lca(a, b) == tree.lca(a, b)
+    for id in ids:
+        assert tree.index.depth[id] == len(tree.ancestors(id)) - 1
+
+def test_remove():
+    tree = Tree()
+    tree.add('1', '0')
+    tree.index.remove('1')
+    assert '1' not in tree.index.depth
@@ -0,0 +1,54 @@
+import random
+import pytest
+from objectsync_server.children import ChildIndex
+
+def check(index : ChildIndex, reference : list):
+    assert list(index) == reference
+    assert list(reversed(index)) == reference[::-1]
+    assert len(index) == len(reference)
+    for position, id in enumerate(reference):
+        assert index[position] == id
+        assert index.index(id) == position
+        assert id in index
+    if reference:
+        assert index[-1] == reference[-1]
+
+def test_keeps_order_through_removes():
+    index = ChildIndex(['a', 'b', 'c', 'd'])
+    index.remove('b')
+    index.append('e')
+    check(index, ['a', 'c', 'd', 'e'])
+    assert 'b' not in index
+    assert index[1:3] == ['c', 'd']
+
+def test_rejects_duplicates_and_missing_ids():
+    index = ChildIndex(['a'])
+    with pytest.raises(ValueError):
+        index.append('a')
+    with pytest.raises(KeyError):
+        index.remove('b')
+    with pytest.raises(IndexError):
+        index[1]
+
+def test_matches_a_list():
+    rng = random.Random(0)
+    index = ChildIndex()
+    reference = []
+    for i in range(3000):
+        if reference and rng.random() < 0.45:
+            id = rng.choice(reference)
+            index.remove(id)
+            reference.remove(id)
+        else:
+            index.append(str(i))
+            reference.append(str(i))
+        if i % 100 == 0:
+            check(index, reference)
+    check(index, reference)
+
+def test_compacts_holes():
+    index = ChildIndex(str(i) for i in range(100))
+    for i in range(90):
+        index.remove(str(i))
+    assert len(index.ids) < 100
+    check(index, [str(i) for i in range(90, 100)])
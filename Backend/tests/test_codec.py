@@ -0,0 +1,104 @@
+import struct
+import pytest
+msgpack = pytest.importorskip('msgpack')
+from objectsync_server.codec import MsgpackCodec, TypedValue, COMMAND_CODES, PROTOCOL_KEYS, VECTOR3, msgpack_array_header
+
+class Decoder:
+    '''
+    The client's side of the encoding: keeps the intern table from intern messages and expands messages with it.
+    '''
+    def __init__(self):
+        self.names = {}
+        self.commands = {code : command for command, code in COMMAND_CODES.items()}
+
+    def define(self, data : bytes):
+        first, names = msgpack.unpackb(data)
+        for i, name in enumerate(names):
+            self.names[first + i] = name
+
+    def decode(self, data : bytes):
+        return self.expand_message(msgpack.unpackb(data, strict_map_key = False, ext_hook = self.ext))
+
+    def ext(self, code, data):
+        assert code == VECTOR3
+        return dict(zip('xyz', struct.unpack('<3f', data)))
+
+    def key(self, key):
+        return self.names[key] if isinstance(key, int) else key
+
+    def expand_message(self, m : dict):
+        result = {}
+        for k, v in m.items():
+            k = self.key(k)
+            if k == 'command':
+                v = self.commands[v]
+            elif k == 'name':
+                v = self.names[v]
+            elif k in ('d', 'root_object'):
+                v = self.expand_object(v)
+            result[k] = v
+        return result
+
+    def expand_object(self, d : dict):
+        result = {}
+        for k, v in d.items():
+            k = self.key(k)
+            if k == 'attributes':
+                v = {self.names[name] : {self.key(ak) : av for ak, av in attr.items()} for name, attr in v.items()}
+            elif k == 'children':
+                v = [self.expand_object(child) for child in v]
+            result[k] = v
+        return result
+
+def connect(codec : MsgpackCodec) -> Decoder:
+    decoder = Decoder()
+    decoder.define(codec.encode_names())
+    return decoder
+
+def send(codec : MsgpackCodec, decoder : Decoder, message):
+    data, new_names = codec.encode(message)
+    if new_names:
+        decoder.define(codec.encode_names(new_names))
+    return decoder.decode(data)
+
+def test_protocol_keys_have_fixed_codes():
+    codec = MsgpackCodec()
+    assert [codec.names[key] for key in PROTOCOL_KEYS] == list(range(len(PROTOCOL_KEYS)))
+    data, new_names = codec.encode({'command' : 'destroy', 'id' : '5'})
+    assert new_names == []
+    assert msgpack.unpackb(data, strict_map_key = False) == {codec.names['command'] : COMMAND_CODES['destroy'], codec.names['id'] : '5'}
+
+def test_interns_attribute_names_once():
+    codec = MsgpackCodec()
+    decoder = connect(codec)
+    message = {'command' : 'attribute', 'id' : '1', 'name' : 'label', 'value' : TypedValue('a', 'String')}
+    assert send(codec, decoder, message) == {'command' : 'attribute', 'id' : '1', 'name' : 'label', 'value' : 'a'}
+    _, new_names = codec.encode(message)
+    assert new_names == []
+
+    # A client that connects later gets the whole table
+    assert send(codec, connect(codec), message)['name'] == 'label'
+
+def test_round_trips_an_object():
+    codec = MsgpackCodec()
+    decoder = connect(codec)
+    d = {'id' : '2', 'type' : 'Box', 'frontend_type' : 'Box', 'attributes' : {
+        'parent_id' : {'type' : 'String', 'value' : '0', 'history_object' : 'none'},
+        'pos' : {'type' : 'Vector3', 'value' : {'x' : 1.0, 'y' : 2.5, 'z' : -3.0}, 'history_object' : 'self'},
+        'data' : {'type' : 'Dict', 'value' : {'x' : 1, 'y' : 2, 'z' : 3, 'other' : 'key'}, 'history_object' : 'none'},
+    }, 'children' : []}
+    decoded = send(codec, decoder, {'command' : 'create', 'd' : d})
+    assert decoded == {'command' : 'create', 'd' : d}
+
+def test_packs_only_vector3_attributes():
+    codec = MsgpackCodec()
+    vector = {'x' : 1.0, 'y' : 2.0, 'z' : 3.0}
+    packed, _ = codec.encode({'command' : 'attribute', 'id' : '1', 'name' : 'pos', 'value' : TypedValue(vector, 'Vector3')})
+    assert msgpack.unpackb(packed, strict_map_key = False)[codec.names['value']] == msgpack.ExtType(VECTOR3, struct.pack('<3f', 1, 2, 3))
+    packed, _ = codec.encode({'command' : 'attribute', 'id' : '1', 'name' : 'data', 'value' : TypedValue(vector, 'Dict')})
+    assert msgpack.unpackb(packed, strict_map_key = False)[codec.names['value']] == vector
+
+def test_array_header_joins_encoded_messages():
+    for length in (0, 15, 16, 70000):
+        items = [msgpack.packb(i) for i in range(length)]
+        assert msgpack_array_header(length) + b''.join(items) == msgpack.packb(list(range(length)))
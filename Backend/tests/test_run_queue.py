@@ -0,0 +1,60 @@
+from Environment import RunQueue
+
+def drain(queue : RunQueue) -> list:
+    return [queue.pop() for _ in range(len(queue))]
+
+def test_higher_priority_first():
+    queue = RunQueue()
+    queue.push('low', 0)
+    queue.push('high', 10)
+    queue.push('middle', 5)
+    assert drain(queue) == ['high', 'middle', 'low']
+
+def test_lifo_and_fifo():
+    lifo = RunQueue('lifo')
+    fifo = RunQueue('fifo')
+    for item in 'abc':
+        lifo.push(item)
+        fifo.push(item)
+    assert drain(lifo) == ['c', 'b', 'a']
+    assert drain(fifo) == ['a', 'b', 'c']
+
+    # push(fifo=True) keeps posted tasks in order in a lifo queue
+    for item in 'abc':
+        lifo.push(item, fifo = True)
+    assert drain(lifo) == ['a', 'b', 'c']
+
+def test_dedup_raises_priority():
+    queue = RunQueue()
+    assert queue.push('a', 0)
+    queue.push('b', 1)
+    assert not queue.push('a', 0)
+    assert queue.push('a', 5)
+    assert len(queue) == 2
+    assert queue.pop(with_priority = True) == ('a', 5)
+    assert drain(queue) == ['b']
+    assert queue.stats()['deduplicated'] == 2
+
+def test_cancel():
+    queue = RunQueue()
+    for i in range(100):
+        queue.push(i, i % 3)
+    for i in range(0, 100, 2):
+        assert queue.cancel(i)
+    assert not queue.cancel(0)
+    assert 0 not in queue
+    items = drain(queue)
+    assert sorted(items) == list(range(1, 100, 2))
+    assert [i % 3 for i in items] == sorted((i % 3 for i in items), reverse = True)
+
+def test_running_item_can_be_queued_again():
+    queue = RunQueue()
+    queue.push('a')
+    item = queue.pop()
+    queue.start(item)
+    assert queue.is_running('a')
+    assert queue.push('a')
+    assert not queue.push('a')
+    queue.done('a')
+    assert not queue.is_running('a')
+    assert drain(queue) == ['a']
@@ -0,0 +1,79 @@
+import os
+from objectsync_server import Space, Object
+from objectsync_server.object import Attribute
+from objectsync_server import wal
+
+class Box(Object):
+    frontend_type = 'Box'
+    def initialize(self):
+        Attribute(self, 'color', 'String', 'red') # Not in any history
+
+class LoggedSpace(Space):
+    def main_loop(self):
+        pass
+
+def open_space(directory) -> LoggedSpace:
+    space = LoggedSpace('w', {'Box' : Box})
+    space.save_dir = str(directory)
+    space.recover()
+    return space
+
+def commit(space : Space):
+    with space.operation_log.lock:
+        space.operation_log.commit()
+
+def send(space : Space, m : dict):
+    space.handle_message(m, None)
+
+def test_replays_undo_and_redo(tmp_path):
+    space = open_space(tmp_path)
+    id = str(next(LoggedSpace('probe', {'Box' : Box}).id_iter))
+    send(space, {'command' : 'create', 'parent' : '0', 'd' : {'type' : 'Box'}})
+    send(space, {'command' : 'undo', 'id' : '0'})
+    commit(space)
+    assert id not in open_space(tmp_path).objs
+
+    space = open_space(tmp_path)
+    send(space, {'command' : 'create', 'parent' : '0', 'd' : {'type' : 'Box'}})
+    send(space, {'command' : 'undo', 'id' : '0'})
+    send(space, {'command' : 'redo', 'id' : '0'})
+    commit(space)
+    assert id in open_space(tmp_path).objs
+
+def test_replays_history_less_change_in_a_batch(tmp_path):
+    space = open_space(tmp_path)
+    id = str(next(LoggedSpace('probe', {'Box' : Box}).id_iter))
+    send(space, {'command' : 'batch', 'commands' : [
+        {'command' : 'create', 'parent' : '0', 'd' : {'type' : 'Box'}},
+        {'command' : 'attribute', 'id' : id, 'name' : 'color', 'value' : 'blue'},
+    ]})
+    commit(space)
+
+    recovered = open_space(tmp_path)
+    assert recovered[id].attributes['color'].value == 'blue'
+
+def test_replays_new_and_deleted_attributes(tmp_path):
+    space = open_space(tmp_path)
+    for m in [
+        {'command' : 'new attribute', 'id' : '0', 'name' : 'a', 'type' : 'String', 'value' : '1', 'history_object' : 'none'},
+        {'command' : 'new attribute', 'id' : '0', 'name' : 'b', 'type' : 'String', 'value' : '2', 'history_object' : 'none'},
+        {'command' : 'attribute', 'id' : '0', 'name' : 'a', 'value' : '3'},
+        {'command' : 'delete attribute', 'id' : '0', 'name' : 'b'},
+    ]:
+        send(space, m)
+    commit(space)
+
+    recovered = open_space(tmp_path)
+    assert recovered.root_obj.attributes['a'].value == '3'
+    assert 'b' not in recovered.root_obj.attributes
+
+def test_read_log_stops_at_a_torn_record(tmp_path):
+    log = wal.OperationLog(str(tmp_path), 'w', 0)
+    for i in range(3):
+        log.append({'op' : 'destroy', 'id' : str(i)})
+    with log.lock:
+        log.commit()
+    path = wal.log_path(str(tmp_path), 'w', 0)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 2)
+    assert [record['id'] for record in wal.read_log(path)] == ['0', '1']